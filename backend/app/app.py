@@ -1,40 +1,406 @@
-from flask import Flask, jsonify
+from flask import Flask, Request, Response, g, jsonify, request
 from flask_cors import CORS
-import sqlite3
+from PIL import Image
+import tempfile
+import hmac
+import math
+import threading
+import gc
+import time
+import uuid
+import sys
 import os
 
+from db import Database
+from flower_kb import FlowerKnowledgeBase, normalize_name
+from recommend import BouquetRecommender
+from jobs import JobQueue
+from metrics import Registry, SampledProfiler
+
+# inference code lives next to the app
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'trained_model'))
+from batcher import MicroBatcher
+from model_pool import ModelPool
+from prediction_cache import PredictionCache
+
+upload_dir = os.environ.get('FLOWER_UPLOAD_DIR', os.path.join(os.path.dirname(__file__), 'uploads'))
+os.makedirs(upload_dir, exist_ok=True)
+
+
+# multipart file parts are streamed straight into the upload folder in chunks,
+# instead of being held in memory or spooled to a temp file and copied again
+class UploadRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.part_files = []  # every part streamed to disk, see remove_upload_parts
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        part = tempfile.NamedTemporaryFile('wb+', dir=upload_dir, prefix='.part-', delete=False)
+        self.part_files.append(part)
+        return part
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('FLOWER_MAX_UPLOAD_MB', 32)) * 1024 * 1024
 # This is for production
 # CORS(app, resources={r"/api/*": {"origins": "http://frontend:3000"}})
 CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}})
 
-db_path = os.path.join(os.path.dirname(__file__), 'database.db')
+# created by init_db, not tracked in git
+db_path = os.environ.get('FLOWER_DB', os.path.join(os.path.dirname(__file__), 'database.db'))
+db = Database(db_path)
+kb = FlowerKnowledgeBase(db)
+
+# inference settings, overridable from the environment
+model_dir = os.path.join(os.path.dirname(__file__), '..', 'trained_model')
+weights_path = os.environ.get('FLOWER_WEIGHTS', os.path.join(model_dir, 'test1.2_best_model.pt'))
+seg_path = os.environ.get('FLOWER_SEG_WEIGHTS', os.path.join(model_dir, 'flowers_segmentation_model.pt'))
+crop_mode = os.environ.get('FLOWER_CROP_MODE', 'mask')  # 'mask' or 'box'
+seg_imgsz = int(os.environ.get('FLOWER_SEG_IMGSZ', 640))
+# shortest side uploads are decoded down to, unset picks it from the crop mode, 0 decodes at full size
+decode_size = int(os.environ['FLOWER_DECODE_SIZE']) if os.environ.get('FLOWER_DECODE_SIZE') else None
+max_batch_size = int(os.environ.get('FLOWER_MAX_BATCH', 8))
+max_wait_ms = float(os.environ.get('FLOWER_MAX_WAIT_MS', 5))
+cache_size = int(os.environ.get('FLOWER_CACHE_SIZE', 1024))
+# on-disk prediction cache sits next to database.db, set FLOWER_CACHE_DB='' for memory only
+cache_db_path = os.environ.get('FLOWER_CACHE_DB', os.path.join(os.path.dirname(__file__), 'prediction_cache.db'))
+# FLOWER_WORKERS > 0 runs the models in that many processes (ModelPool) instead of in this one,
+# each with FLOWER_WORKER_THREADS torch threads (default: the cores split evenly)
+model_workers = int(os.environ.get('FLOWER_WORKERS', 0))
+worker_threads = int(os.environ.get('FLOWER_WORKER_THREADS', 0)) or None
+# how long load_model waits for the pool's workers to load before /ready reports a failure
+worker_start_timeout = float(os.environ.get('FLOWER_WORKER_START_TIMEOUT', 300))
+
+classifier = None
+classifier_lock = threading.Lock()
+batcher = None
+batcher_pid = None
+batcher_lock = threading.Lock()
+model_error = None
+torch_threads = None  # set by preload_model, restored in each forked worker
+
+# classification runs as background jobs, uploads return straight away with a job id.
+# job status lives in the database too, so a poll may land on any gunicorn worker
+jobs = JobQueue(max_workers=int(os.environ.get('FLOWER_JOB_WORKERS', 8)), store=db)
+
+recommender = None
+recommender_lock = threading.Lock()
 
+# instrumentation, scraped from /metrics
+metrics = Registry()
+request_seconds = metrics.histogram('flower_request_seconds', 'time to handle a request', ('endpoint', 'method', 'status'))
+job_seconds = metrics.histogram('flower_job_seconds', 'time to run a classification job', ('kind', 'outcome'))
+stage_seconds = metrics.histogram('flower_stage_seconds', 'time per ClassifyFlower pipeline stage', ('stage',))
+batch_size = metrics.histogram('flower_batch_size', 'images per classifier batch', buckets=(1, 2, 4, 8, 16, 32, 64))
+model_load_seconds = metrics.gauge('flower_model_load_seconds', 'time it took to load both models')
+metrics.gauge('flower_jobs_pending', 'classification jobs queued or running', fn=lambda: jobs.pending())
+metrics.gauge('flower_batcher_queue_depth', 'requests waiting for the micro-batcher',
+              fn=lambda: batcher.queue.qsize() if batcher is not None else 0)
+metrics.counter('flower_cache_lookups_total', 'prediction cache lookups by result', ('result',), fn=lambda: cache_lookups())
+metrics.gauge('flower_cache_hit_rate', 'fraction of prediction cache lookups that hit',
+              fn=lambda: (cache_stats() or {}).get('hit_rate'))
+
+# sampled cProfile over requests and jobs, off unless FLOWER_PROFILE_RATE or POST /metrics/profile turns it on
+profiler = SampledProfiler(float(os.environ.get('FLOWER_PROFILE_RATE', 0)))
+# reading or changing it needs this token in an X-Admin-Token header, unset disables /metrics/profile
+profile_token = os.environ.get('FLOWER_PROFILE_TOKEN', '')
+
+# prediction cache counters of the in-process classifier, or summed over the pool's workers
+def cache_stats():
+    if classifier is None:
+        return None
+    if isinstance(classifier, ModelPool):
+        return classifier.cache_stats()
+    return classifier.cache.stats()
+
+def cache_lookups():
+    stats = cache_stats()
+    if stats is None:
+        return {}
+    return {('memory_hit',): stats['hits'] - stats['disk_hits'], ('disk_hit',): stats['disk_hits'],
+            ('miss',): stats['misses']}
+
+# create the tables and seed the knowledge base, once per deployment (gunicorn on_starting, run.py __main__)
 def init_db():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-      userid INTEGER PRIMARY KEY AUTOINCREMENT,
-      name TEXT NOT NULL,
-      hpword TEXT NOT NULL
-    ) ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS uploads (
-      fileid INTEGER PRIMARY KEY AUTOINCREMENT,
-      filename TEXT NOT NULL,
-      userid INTEGER NOT NULL
-    ) ''')
-    conn.commit()
-    conn.close()
+    db.init()
+    kb.init()
     return None
 
+# built on first use in each process, from the knowledge base init_db filled
+def get_recommender():
+    global recommender
+    with recommender_lock:
+        if recommender is None:
+            recommender = BouquetRecommender(kb)
+        return recommender
+
+# build the classifier once, in the gunicorn master when preloading, otherwise in this process
+def load_model():
+    global classifier
+    with classifier_lock:
+        if classifier is None and model_workers > 0:
+            # the worker processes import torch and map the weights, this process never does
+            start = time.perf_counter()
+            pool = ModelPool(model_workers, worker_threads, cache_args=(cache_size, cache_db_path or None),
+                             stage_hook=lambda stage, seconds: stage_seconds.observe(seconds, stage=stage),
+                             weights_path=weights_path, seg_path=seg_path, crop_mode=crop_mode, seg_imgsz=seg_imgsz,
+                             decode_size=decode_size)
+            try:
+                pool.wait_ready(worker_start_timeout)
+            except Exception:
+                pool.close()
+                raise
+            classifier = pool
+            model_load_seconds.set(time.perf_counter() - start)
+        elif classifier is None:
+            # torch/torchvision/ultralytics are only imported here, never at app import
+            from cnn_inference import ClassifyFlower
+            from model_init import get_model
+            start = time.perf_counter()
+            classifier = ClassifyFlower(get_model, weights_path, seg_path,
+                                        crop_mode=crop_mode, seg_imgsz=seg_imgsz, decode_size=decode_size,
+                                        cache=PredictionCache(cache_size, cache_db_path or None),
+                                        stage_hook=lambda stage, seconds: stage_seconds.observe(seconds, stage=stage))
+            model_load_seconds.set(time.perf_counter() - start)
+        return classifier
+
+# threads don't survive a fork, so every process warms up and starts its own batching worker
+def get_batcher():
+    global batcher, batcher_pid
+    model = load_model()
+    with batcher_lock:
+        if batcher_pid != os.getpid():
+            if torch_threads is not None:
+                import torch
+                torch.set_num_threads(torch_threads)
+            model.warmup()
+            # one batch in flight per model process
+            batcher = MicroBatcher(predict_batch, max_batch_size, max_wait_ms, workers=max(1, model_workers))
+            batcher_pid = os.getpid()
+        return batcher
+
+# load and warm up in the background so the server answers (and /ready reports progress) straight away
+def start_model_loader():
+    def run():
+        global model_error
+        model_error = None
+        try:
+            get_batcher()
+        except Exception as e:
+            model_error = f'{type(e).__name__}: {e}'
+    threading.Thread(target=run, name='model-loader', daemon=True).start()
+
+def preload_model():
+    '''
+    gunicorn --preload: load the weights once in the master so forked workers share them copy-on-write.
+    the master stays single threaded, GNU OpenMP deadlocks in a child once its pool has started,
+    and gc.freeze keeps the collector from touching (and so copying) the preloaded objects
+    '''
+    global torch_threads, model_error
+    if model_workers > 0:
+        # the pool is spawned per server process by start_model_loader, nothing to share from here
+        return
+    import torch
+    torch_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        load_model()
+    except Exception as e:
+        # workers retry in the background and report the error on /ready
+        model_error = f'{type(e).__name__}: {e}'
+    gc.freeze()
+
+# the batcher's worker runs the models on its own thread, so it is sampled separately from jobs
+def predict_batch(items):
+    batch_size.observe(len(items))
+    with profiler.sample():
+        return classifier.predict_batch(items)
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    g.profile = profiler.start()
+
+@app.after_request
+def record_request(response):
+    request_seconds.observe(time.perf_counter() - g.start, endpoint=request.endpoint or 'unknown',
+                            method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def stop_request(error):
+    profiler.stop(g.pop('profile', None))
+
+# parts the view did not move into place are deleted: other fields, repeated 'image' parts,
+# and partial files from uploads that were aborted, disconnected or too large
+@app.teardown_request
+def remove_upload_parts(error):
+    for part in request.part_files:
+        part.close()
+        try:
+            os.remove(part.name)
+        except FileNotFoundError:
+            pass
+
 # Home route
 @app.route('/')
 def home():
     return jsonify(message = "Hi")
 
+# readiness for load balancers/orchestrators: 200 once this process can classify, 503 while loading
+@app.route('/ready')
+def ready():
+    if batcher is not None and batcher_pid == os.getpid():
+        return jsonify(status = "ready")
+    if model_error is not None:
+        return jsonify(status = "failed", error = model_error), 503
+    return jsonify(status = "loading"), 503
+
+# background job: classify a saved upload, timed and sometimes profiled
+def classify_upload(path, bouquet):
+    start = time.perf_counter()
+    outcome = 'failed'
+    try:
+        with profiler.sample():
+            result = run_classification(path, bouquet)
+        outcome = 'error' if 'error' in result else 'done'
+        return result
+    finally:
+        job_seconds.observe(time.perf_counter() - start, kind='bouquet' if bouquet else 'single', outcome=outcome)
+
+def run_classification(path, bouquet):
+    worker = get_batcher()
+
+    # bouquet photos: classify every detected flower in one pass
+    if bouquet:
+        flowers = classifier.predict_bouquet(path)
+        for flower in flowers:
+            flower['language'] = kb.lookup(flower['species'], flower['color'])
+        return {'flowers': flowers}
+
+    # repeat uploads skip the queue, everything else is grouped into one forward pass by the batcher
+    cached = classifier.cached_prediction(path)
+    species, color = cached if cached is not None else worker.predict(path)
+    if species is None:
+        return {'error': 'no flower detected'}
+    return {'species': species, 'color': color, 'language': kb.lookup(species, color)}
+
 # Upload route
-@app.route('/upload')
+@app.route('/upload', methods=['POST'])
 def upload():
-    return
+    if 'image' not in request.files:
+        return jsonify(error = "no image uploaded"), 400
+
+    # the part was streamed to a temporary file in upload_dir, give it its final name
+    # (every other part is removed by remove_upload_parts)
+    part = request.files['image']
+    tmp_path = part.stream.name
+    part.stream.close()
+    try:
+        with Image.open(tmp_path) as img:  # only parses the header
+            ext = (img.format or 'img').lower()
+    except Exception:
+        return jsonify(error = "could not read image"), 400
+
+    filename = f'{uuid.uuid4().hex}.{ext}'
+    path = os.path.join(upload_dir, filename)
+    os.replace(tmp_path, path)
+
+    userid = request.form.get('userid', 0, type=int)
+    fileid = db.record_upload(filename, userid)
+
+    bouquet = request.form.get('bouquet') in ('1', 'true')
+    job_id = jobs.submit(classify_upload, path, bouquet)
+
+    # optionally wait a little so fast (e.g. cached) results come back in one round trip, JobQueue clamps it
+    job = jobs.status(job_id, wait=request.args.get('wait', 0, type=float))
+    job['fileid'] = fileid
+    return jsonify(job), 200 if job['status'] != 'pending' else 202
+
+# poll (or ?wait=<seconds> for) a classification job
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.status(job_id, wait=request.args.get('wait', 0, type=float))
+    if job is None:
+        return jsonify(error = "unknown job"), 404
+    return jsonify(job)
+
+# a user's saved uploads, newest first
+@app.route('/users/<int:userid>/uploads')
+def user_uploads(userid):
+    # sqlite reads a negative LIMIT as no limit, so clamp from both sides
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return jsonify(uploads = db.list_uploads(userid, limit, offset))
+
+# what a species in a given color means, with pairing suggestions
+@app.route('/api/flowers/<species>/<color>')
+def flower_meaning(species, color):
+    entry = kb.lookup(species, color)
+    if entry is None:
+        return jsonify(error = "unknown species or color"), 404
+    return jsonify(entry)
+
+# full-text search over flower meanings, e.g. /api/flowers/search?q=friendship
+@app.route('/api/flowers/search')
+def flower_search():
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    return jsonify(results = kb.search(request.args.get('q', ''), limit))
+
+# bouquet ideas for an occasion, optionally built around flowers the user already has
+# body: {"occasion": "anniversary", "flowers": [{"species": "rose", "color": "red"}], "size": 3, "count": 3}
+@app.route('/api/recommend', methods=['POST'])
+def recommend():
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return jsonify(error = "body must be a JSON object"), 400
+    occasion, flowers = body.get('occasion', ''), body.get('flowers', [])
+    if not isinstance(occasion, str) or not isinstance(flowers, list):
+        return jsonify(error = "occasion must be a string and flowers a list"), 400
+    size, count = body.get('size', 3), body.get('count', 3)
+    # bool is an int subclass, and json reads 1e400 as inf, so only plain ints get through
+    if type(size) is not int or type(count) is not int:
+        return jsonify(error = "size and count must be integers"), 400
+    size, count = max(1, min(size, 12)), max(1, min(count, 10))
+
+    detected = [(normalize_name(f['species']), normalize_name(f['color'])) for f in flowers
+                if isinstance(f, dict) and isinstance(f.get('species'), str) and isinstance(f.get('color'), str)]
+    bouquets = get_recommender().recommend(occasion, detected, size, count)
+    return jsonify(bouquets = bouquets)
+
+# prometheus scrape endpoint
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# sampled profiler: GET for the top functions so far, POST {"rate": 0.01, "reset": true} to change it at runtime
+# both need the admin token, the report shows internal file paths and function names
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def profile():
+    if not profile_token or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), profile_token):
+        return jsonify(error = "the profiler needs FLOWER_PROFILE_TOKEN"), 403
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if body is None:
+            body = {}
+        if not isinstance(body, dict):
+            return jsonify(error = "body must be a JSON object"), 400
+        if 'rate' in body:
+            try:
+                rate = float(body['rate'])
+            except (TypeError, ValueError):
+                rate = math.nan
+            if math.isnan(rate):
+                return jsonify(error = "rate must be a number"), 400
+            profiler.rate = max(0.0, min(rate, 1.0))
+        if body.get('reset'):
+            profiler.reset()
+        return jsonify(rate = profiler.rate, samples = profiler.samples)
+    limit = max(1, min(request.args.get('limit', 30, type=int), 200))
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in profiler.SORT_KEYS:
+        return jsonify(error = f"sort must be one of {', '.join(profiler.SORT_KEYS)}"), 400
+    return Response(profiler.report(limit, sort), mimetype='text/plain')
@@ -0,0 +1,106 @@
+# sqlite access for the backend: one reusable connection per thread, WAL journaling
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+  userid INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  hpword TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+  fileid INTEGER PRIMARY KEY AUTOINCREMENT,
+  filename TEXT NOT NULL,
+  userid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_userid ON uploads(userid, fileid);
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id TEXT PRIMARY KEY,
+  status TEXT NOT NULL,
+  result TEXT,
+  created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs(created);
+'''
+
+# statements are kept as constants so each connection's statement cache reuses the prepared versions
+INSERT_UPLOAD = 'INSERT INTO uploads (filename, userid) VALUES (?, ?)'
+LIST_UPLOADS = 'SELECT fileid, filename FROM uploads WHERE userid = ? ORDER BY fileid DESC LIMIT ? OFFSET ?'
+INSERT_JOB = "INSERT INTO jobs (job_id, status, created) VALUES (?, 'pending', ?)"
+FINISH_JOB = 'UPDATE jobs SET status = ?, result = ? WHERE job_id = ?'
+PRUNE_JOBS = 'DELETE FROM jobs WHERE created < (SELECT created FROM jobs ORDER BY created DESC LIMIT 1 OFFSET ?)'
+GET_JOB = 'SELECT status, result FROM jobs WHERE job_id = ?'
+
+
+class Database:
+    def __init__(self, path):
+        '''
+        path: PATH to the sqlite file
+        connections are opened lazily, one per thread, and reused for the life of that thread
+        '''
+        self.path = path
+        self.local = threading.local()
+
+        # connections must not cross a fork (gunicorn --preload), forked workers open their own
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+
+    def _forget_connections(self):
+        self.local = threading.local()
+
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=256)
+            # readers never block the writer and vice versa, fsync only at checkpoints
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self.local.conn = conn
+        return conn
+
+
+    def init(self):
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+
+    # returns the new fileid
+    # /upload takes one image per request, so uploads are recorded one row at a time (there is no batch insert)
+    def record_upload(self, filename, userid):
+        conn = self.connection()
+        with conn:
+            return conn.execute(INSERT_UPLOAD, (filename, userid)).lastrowid
+
+
+    def create_job(self, job_id, created):
+        conn = self.connection()
+        with conn:
+            conn.execute(INSERT_JOB, (job_id, created))
+
+
+    # store a finished job's status and JSON result, keeping only the newest keep jobs
+    def finish_job(self, job_id, status, result, keep:int=1000):
+        conn = self.connection()
+        with conn:
+            conn.execute(FINISH_JOB, (status, json.dumps(result) if result is not None else None, job_id))
+            conn.execute(PRUNE_JOBS, (keep - 1,))
+
+
+    # (status, result) of a job, None for unknown ids
+    def get_job(self, job_id):
+        row = self.connection().execute(GET_JOB, (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, result = row
+        return status, json.loads(result) if result is not None else None
+
+
+    # a user's uploads, newest first, served from the uploads(userid, fileid) index
+    def list_uploads(self, userid, limit:int=50, offset:int=0):
+        rows = self.connection().execute(LIST_UPLOADS, (userid, limit, offset)).fetchall()
+        return [{'fileid': fileid, 'filename': filename} for fileid, filename in rows]
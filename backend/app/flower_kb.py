@@ -0,0 +1,158 @@
+# flower-language knowledge base: species, colors, their meanings and pairings
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS species (
+  species_id INTEGER PRIMARY KEY,
+  name TEXT UNIQUE NOT NULL,
+  scientific_name TEXT,
+  meaning TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS colors (
+  color_id INTEGER PRIMARY KEY,
+  name TEXT UNIQUE NOT NULL,
+  meaning TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meanings (
+  species_id INTEGER NOT NULL REFERENCES species(species_id),
+  color_id INTEGER NOT NULL REFERENCES colors(color_id),
+  meaning TEXT NOT NULL,
+  PRIMARY KEY (species_id, color_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pairings (
+  species_id INTEGER NOT NULL REFERENCES species(species_id),
+  pair_species_id INTEGER NOT NULL REFERENCES species(species_id),
+  score REAL NOT NULL,
+  note TEXT,
+  PRIMARY KEY (species_id, pair_species_id)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS meanings_fts USING fts5(species, color, meaning);
+'''
+
+# every (species, color) cell with its pairings, in one pass over the primary-key indexes
+GRID_QUERY = '''
+SELECT m.species_id, m.color_id, s.name, c.name, m.meaning, s.meaning, c.meaning, s.scientific_name,
+       ps.name, p.score, p.note
+FROM meanings m
+JOIN species s ON s.species_id = m.species_id
+JOIN colors c ON c.color_id = m.color_id
+LEFT JOIN pairings p ON p.species_id = m.species_id
+LEFT JOIN species ps ON ps.species_id = p.pair_species_id
+ORDER BY m.species_id, m.color_id, p.score DESC
+'''
+
+SEARCH_QUERY = 'SELECT rowid FROM meanings_fts WHERE meanings_fts MATCH ? ORDER BY rank LIMIT ?'
+
+seed_path = os.path.join(os.path.dirname(__file__), 'flower_language.json')
+
+
+# 'Black-eyed Susan' -> 'black_eyed_susan', the classifier's label format
+def normalize_name(name):
+    return name.strip().lower().replace('-', '_').replace(' ', '_')
+
+
+class FlowerKnowledgeBase:
+    def __init__(self, db):
+        '''
+        db: Database the tables live in
+        lookups are served from an in-memory copy of the whole 16 x 8 species/color grid
+        '''
+        self.db = db
+        self.grid = None
+        self.lock = threading.Lock()
+
+
+    # create the tables and fill them from flower_language.json the first time
+    def init(self):
+        conn = self.db.connection()
+        conn.executescript(SCHEMA)
+        if conn.execute('SELECT COUNT(*) FROM species').fetchone()[0] == 0:
+            with open(seed_path) as f:
+                self.seed(conn, json.load(f))
+        conn.commit()
+
+
+    @staticmethod
+    def seed(conn, data):
+        species_ids = {s['name']: i for i, s in enumerate(data['species'])}
+        color_ids = {c['name']: i for i, c in enumerate(data['colors'])}
+        overrides = {(m['species'], m['color']): m['meaning'] for m in data['meanings']}
+
+        conn.executemany('INSERT INTO species VALUES (?, ?, ?, ?)',
+                         [(species_ids[s['name']], s['name'], s['scientific_name'], s['meaning']) for s in data['species']])
+        conn.executemany('INSERT INTO colors VALUES (?, ?, ?)',
+                         [(color_ids[c['name']], c['name'], c['meaning']) for c in data['colors']])
+
+        # every cell gets a meaning: the specific one if known, otherwise species + color symbolism
+        rows = []
+        for s in data['species']:
+            for c in data['colors']:
+                meaning = overrides.get((s['name'], c['name']), f"{s['meaning']}, with {c['meaning']}")
+                rows.append((species_ids[s['name']], color_ids[c['name']], meaning))
+        conn.executemany('INSERT INTO meanings VALUES (?, ?, ?)', rows)
+        conn.executemany('INSERT INTO meanings_fts (rowid, species, color, meaning) VALUES (?, ?, ?, ?)',
+                         [(sid * len(color_ids) + cid, data['species'][sid]['name'].replace('_', ' '),
+                           data['colors'][cid]['name'], meaning) for sid, cid, meaning in rows])
+
+        # pairings work both ways
+        pairs = []
+        for p in data['pairings']:
+            a, b = species_ids[p['species']], species_ids[p['with']]
+            pairs += [(a, b, p['score'], p['note']), (b, a, p['score'], p['note'])]
+        conn.executemany('INSERT OR REPLACE INTO pairings VALUES (?, ?, ?, ?)', pairs)
+
+
+    # build the in-memory grid with one query, keyed by (species, color) names
+    def load(self):
+        with self.lock:
+            if self.grid is not None:
+                return self.grid
+
+            grid, by_rowid = {}, {}
+            num_colors = self.db.connection().execute('SELECT COUNT(*) FROM colors').fetchone()[0]
+            for (species_id, color_id, species, color, meaning, species_meaning, color_meaning,
+                 scientific_name, pair, score, note) in self.db.connection().execute(GRID_QUERY):
+                entry = grid.get((species, color))
+                if entry is None:
+                    entry = grid[(species, color)] = {
+                        'species': species,
+                        'color': color,
+                        'scientific_name': scientific_name,
+                        'meaning': meaning,
+                        'species_meaning': species_meaning,
+                        'color_meaning': color_meaning,
+                        'pairings': [],
+                    }
+                    by_rowid[species_id * num_colors + color_id] = entry
+                if pair is not None:
+                    entry['pairings'].append({'species': pair, 'score': score, 'note': note})
+
+            self.by_rowid = by_rowid
+            self.grid = grid
+            return grid
+
+
+    # meaning and pairing suggestions for a classifier result, None if unknown
+    def lookup(self, species, color):
+        grid = self.grid if self.grid is not None else self.load()
+        return grid.get((normalize_name(species), normalize_name(color)))
+
+
+    # full-text search over every meaning, best matches first
+    def search(self, query, limit:int=20):
+        self.load()
+        # quote each word so user input can't be read as FTS syntax, any word may match as a prefix
+        # (control characters such as NUL end the FTS string early, so they are dropped first)
+        words = (''.join(ch for ch in word if ch.isprintable()) for word in query.split())
+        terms = ' OR '.join('"{}"*'.format(word.replace('"', '""')) for word in words if word)
+        if not terms:
+            return []
+        try:
+            rows = self.db.connection().execute(SEARCH_QUERY, (terms, limit)).fetchall()
+        except sqlite3.OperationalError:
+            # a query FTS5 still refuses is treated as matching nothing
+            return []
+        return [self.by_rowid[rowid] for (rowid,) in rows if rowid in self.by_rowid]
@@ -0,0 +1,30 @@
+# gunicorn settings for the container: gunicorn -c app/gunicorn.conf.py run:app
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = '0.0.0.0:5000'
+
+# threads serve requests while classification runs as background jobs.
+# with FLOWER_WORKERS > 0 the models run in their own process pool, one web worker is enough
+# any WEB_CONCURRENCY works for jobs: their status is in the database, a poll can land on any worker
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('FLOWER_THREADS', 16))
+
+# load the weights in the master and fork workers from it, so they share the weights copy-on-write.
+# run.py reads FLOWER_PRELOAD to decide between preloading and loading in the background
+preload_app = os.environ.get('FLOWER_PRELOAD', '1') == '1'
+os.environ['FLOWER_PRELOAD'] = '1' if preload_app else '0'
+
+
+# tables and the knowledge base seed are written once, by the master, before any worker starts
+def on_starting(server):
+    from app import init_db
+    init_db()
+
+
+# preloaded workers inherit the weights but not the master's threads, warm up and start batching here
+def post_fork(server, worker):
+    if preload_app:
+        from app import start_model_loader
+        start_model_loader()
@@ -0,0 +1,68 @@
+# import-time report for the backend, so startup regressions are visible
+# python import_report.py                      (app and cnn_inference, slowest imports first)
+# python import_report.py --module app --max-seconds 0.5 --json report.json
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+model_dir = os.path.join(app_dir, '..', 'trained_model')
+
+# "import time:  self [us] | cumulative | imported package", nesting shown by indentation
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module):
+    '''
+    import module in a fresh interpreter with -X importtime
+    returns (seconds for the whole import, list of {module, self_s, cumulative_s, depth})
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([app_dir, model_dir, os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=app_dir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{proc.stderr[-2000:]}')
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            entries.append({'module': name, 'self_s': int(own) / 1e6, 'cumulative_s': int(cumulative) / 1e6,
+                            'depth': (len(indent) - 1) // 2})
+
+    # top-level entries are the target plus anything it pulled in before site finished
+    total = sum(e['cumulative_s'] for e in entries if e['depth'] == 0 and e['module'] == module)
+    return total, entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', action='append', help='module to import, repeatable (default: app, cnn_inference)')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports listed per module')
+    parser.add_argument('--json', default=None, help='also write the full report here')
+    parser.add_argument('--max-seconds', type=float, default=None, help='exit 1 if any module imports slower than this')
+    args = parser.parse_args()
+
+    report = {}
+    for module in args.module or ['app', 'cnn_inference']:
+        total, entries = import_times(module)
+        report[module] = {'total_s': total, 'imports': entries}
+
+        print(f'{module}: {total * 1000:.0f} ms, {len(entries)} modules')
+        print(f'  {"cumulative ms":>14}{"self ms":>10}  module')
+        for e in sorted(entries, key=lambda e: e['cumulative_s'], reverse=True)[:args.top]:
+            print(f'  {e["cumulative_s"] * 1000:>14.1f}{e["self_s"] * 1000:>10.1f}  {"  " * e["depth"]}{e["module"]}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.max_seconds is not None:
+        slow = [m for m, r in report.items() if r['total_s'] > args.max_seconds]
+        if slow:
+            print(f'over {args.max_seconds}s: {", ".join(slow)}')
+            sys.exit(1)
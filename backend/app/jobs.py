@@ -0,0 +1,114 @@
+# background jobs for slow work (classification) so request threads are not held while it runs.
+# with a store, status is also kept in the database, so any web worker can answer for any job
+import logging
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    # seconds between database checks while waiting on another process's job
+    POLL_INTERVAL = 0.05
+    # longest a status call may block
+    MAX_WAIT = 30
+
+    def __init__(self, max_workers:int=4, keep_finished:int=1000, store=None):
+        '''
+        max_workers: jobs running at once
+        keep_finished: finished jobs remembered for polling, oldest are dropped first
+        store: optional Database shared by every server process, jobs of other processes are read from it.
+        results must be JSON serializable. a job whose process dies stays 'pending' there
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.keep_finished = keep_finished
+        self.store = store
+        self.jobs = {}
+        self.finished = []
+        self.lock = threading.Lock()
+
+
+    # run fn(*args) in the background, returns the job id
+    def submit(self, fn, *args):
+        job_id = uuid.uuid4().hex
+        created = time.time()
+        if self.store is not None:
+            self.store.create_job(job_id, created)
+        future = self.executor.submit(fn, *args)
+        with self.lock:
+            self.jobs[job_id] = {'future': future, 'created': created}
+        future.add_done_callback(lambda future: self._finished(job_id, future))
+        return job_id
+
+
+    def _finished(self, job_id, future):
+        # the details (paths, model errors) go to the server log, clients only see that it failed
+        if future.exception() is not None:
+            logger.error('job %s failed', job_id, exc_info=future.exception())
+        if self.store is not None:
+            failed = future.exception() is not None
+            try:
+                self.store.finish_job(job_id, 'failed' if failed else 'done', None if failed else future.result(),
+                                      self.keep_finished)
+            except Exception:
+                logger.exception('could not store job %s', job_id)
+        with self.lock:
+            self.finished.append(job_id)
+            while len(self.finished) > self.keep_finished:
+                self.jobs.pop(self.finished.pop(0), None)
+
+
+    # jobs submitted but not finished yet, queued or running
+    def pending(self):
+        with self.lock:
+            return len(self.jobs) - len(self.finished)
+
+
+    def status(self, job_id, wait:float=0):
+        '''
+        dict with the job's status ('pending', 'done' or 'failed') plus its result or error,
+        None for unknown ids; wait blocks up to that many seconds for the job to finish,
+        clamped to 0..MAX_WAIT (nan and inf count as 0)
+        '''
+        wait = max(0.0, min(wait, self.MAX_WAIT)) if math.isfinite(wait) else 0.0
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return self._stored_status(job_id, wait)
+
+        future = job['future']
+        if wait > 0 and not future.done():
+            try:
+                future.exception(timeout=wait)
+            except TimeoutError:
+                pass
+
+        if not future.done():
+            return {'job_id': job_id, 'status': 'pending'}
+        if future.exception() is not None:
+            return {'job_id': job_id, 'status': 'failed', 'error': 'job failed'}
+        return {'job_id': job_id, 'status': 'done', 'result': future.result()}
+
+
+    # a job submitted by another process, polled from the store
+    def _stored_status(self, job_id, wait):
+        if self.store is None:
+            return None
+        deadline = time.monotonic() + wait
+        while True:
+            job = self.store.get_job(job_id)
+            if job is None:
+                return None
+            status, result = job
+            if status != 'pending' or time.monotonic() >= deadline:
+                break
+            time.sleep(self.POLL_INTERVAL)
+
+        if status == 'pending':
+            return {'job_id': job_id, 'status': 'pending'}
+        if status == 'failed':
+            return {'job_id': job_id, 'status': 'failed', 'error': 'job failed'}
+        return {'job_id': job_id, 'status': 'done', 'result': result}
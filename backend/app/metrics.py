@@ -0,0 +1,220 @@
+# in-process metrics rendered in the prometheus text format, plus a sampled cProfile profiler
+# cheap enough to leave on: an observation is one bisect and a few adds under a lock
+import bisect
+import cProfile
+import io
+import math
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, covers a cached lookup (sub-millisecond) up to a cold model on CPU
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, name, help, labels=(), fn=None):
+        '''
+        name: metric name as scraped, e.g. flower_requests_total
+        help: one line description for the # HELP comment
+        labels: label names, values are passed as keyword arguments when recording
+        fn: optional callable read at scrape time instead of recorded values, returning a number
+        (or a dict of label tuple -> number when the metric has labels), for state kept elsewhere
+        '''
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    def render(self):
+        if self.fn is not None:
+            value = self.fn()
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return self.header() + [f'{self.name}{format_labels(self.labels, k)} {format_value(v)}'
+                                for k, v in values.items() if v is not None]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # per-bucket counts (not cumulative) plus an overflow slot, then sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    # time a block in seconds
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self.lock:
+            values = {k: (list(counts), total) for k, (counts, total) in self.values.items()}
+        lines = self.header()
+        for key, (counts, total) in values.items():
+            running = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                running += count
+                le = format_labels(self.labels, key, [('le', format_value(bound))])
+                lines.append(f'{self.name}_bucket{le} {running}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {running}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self.register(Counter(name, help, labels, fn))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    # the whole registry in the prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class SampledProfiler:
+    SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+    def __init__(self, rate:float=0.0):
+        '''
+        rate: fraction of requests/jobs to profile, 0 turns profiling off, can be changed at runtime
+        at most one block is profiled at a time, overlapping samples are skipped
+        '''
+        self.rate = rate
+        self.samples = 0
+        self.stats = None
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+
+
+    # start profiling the calling thread if this call is sampled, returns the profile or None
+    def start(self):
+        if self.rate <= 0 or random.random() >= self.rate:
+            return None
+        if not self.active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler (e.g. a debugger) already owns the hook
+            self.active.release()
+            return None
+        return profile
+
+
+    # stop a profile from start() and fold it into the accumulated stats
+    def stop(self, profile):
+        if profile is None:
+            return
+        profile.disable()
+        self.active.release()
+        with self.lock:
+            self.samples += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+
+    @contextmanager
+    def sample(self):
+        profile = self.start()
+        try:
+            yield
+        finally:
+            self.stop(profile)
+
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.stats = None
+
+
+    # top functions across every sample so far as text, sort is one of SORT_KEYS
+    def report(self, limit:int=30, sort:str='cumulative'):
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f'sort must be one of {self.SORT_KEYS}, got {sort!r}')
+        with self.lock:
+            if self.stats is None:
+                return f'no samples (rate={self.rate})\n'
+            out = io.StringIO()
+            self.stats.stream = out
+            out.write(f'{self.samples} samples (rate={self.rate})\n')
+            self.stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
@@ -0,0 +1,153 @@
+# bouquet recommendations: rank species/color combinations for an occasion with numpy
+import re
+import numpy as np
+
+# occasion themes and the words that signal them, both in flower meanings and in user requests
+THEMES = {
+    'love': ['love', 'romance', 'romantic', 'passion', 'desire', 'valentine', 'anniversary', 'adoration', 'affection'],
+    'friendship': ['friend', 'friendship', 'joy', 'cheerful', 'cheer', 'happiness', 'sunshine', 'caring'],
+    'sympathy': ['sympathy', 'funeral', 'condolence', 'condolences', 'loss', 'remembrance', 'grief', 'mourning', 'peace'],
+    'gratitude': ['thank', 'thanks', 'gratitude', 'grateful', 'appreciation'],
+    'celebration': ['celebrate', 'celebration', 'congratulations', 'success', 'graduation', 'birthday', 'party', 'abundance', 'wealth'],
+    'apology': ['sorry', 'apology', 'apologise', 'apologize', 'forgive', 'forgiveness'],
+    'new_beginnings': ['new', 'beginnings', 'baby', 'birth', 'rebirth', 'spring', 'fresh', 'start', 'hope'],
+    'admiration': ['admire', 'admiration', 'respect', 'honour', 'honor', 'dignity', 'nobility', 'royalty', 'compliments'],
+    'encouragement': ['encourage', 'encouragement', 'healing', 'comfort', 'courage', 'recovery', 'motivation', 'resilience', 'get well'],
+    'devotion': ['loyal', 'loyalty', 'devotion', 'commitment', 'constancy', 'faith', 'faithfulness', 'patience', 'dedication'],
+    'purity': ['purity', 'pure', 'innocence', 'wedding', 'bride', 'reverence', 'enlightenment'],
+}
+# meanings that undercut almost any occasion
+NEGATIVE = ['rejection', 'disappointment', 'capriciousness', 'unpredictability', 'unrequited']
+
+COLORS = ['white', 'yellow', 'orange', 'pink', 'red', 'purple', 'maroon', 'brown']
+# how well two colors sit together in one arrangement, 0-1
+HARMONY = {
+    ('yellow', 'orange'): 0.8, ('orange', 'red'): 0.8, ('red', 'maroon'): 0.8, ('pink', 'purple'): 0.8,
+    ('pink', 'red'): 0.7, ('maroon', 'purple'): 0.7, ('orange', 'brown'): 0.8, ('yellow', 'brown'): 0.6,
+    ('yellow', 'purple'): 0.7, ('pink', 'maroon'): 0.5,
+}
+
+
+def theme_vector(text):
+    text = text.lower()
+    words = set(re.findall(r"[a-z']+", text))
+    vector = np.array([sum((kw in text) if ' ' in kw else (kw in words) for kw in kws) for kws in THEMES.values()],
+                      dtype=np.float32)
+    penalty = sum(word in words for word in NEGATIVE)
+    return vector, penalty
+
+
+def color_harmony():
+    n = len(COLORS)
+    harmony = np.full((n, n), 0.3, dtype=np.float32)
+    for (a, b), score in HARMONY.items():
+        i, j = COLORS.index(a), COLORS.index(b)
+        harmony[i, j] = harmony[j, i] = score
+    white = COLORS.index('white')
+    harmony[white, :] = harmony[:, white] = 0.7  # white goes with everything
+    np.fill_diagonal(harmony, 0.6)
+    return harmony
+
+
+class BouquetRecommender:
+    def __init__(self, kb, pairing_weight:float=0.5, pool_size:int=32, beam_width:int=16):
+        '''
+        kb: FlowerKnowledgeBase, its grid is turned into symbolism vectors once
+        pairing_weight: how much species pairings / color harmony count against occasion fit
+        pool_size: only the best pool_size cells for an occasion are considered for a bouquet
+        beam_width: partial bouquets kept while growing them one flower at a time
+        '''
+        self.pairing_weight = pairing_weight
+        self.pool_size = pool_size
+        self.beam_width = beam_width
+
+        grid = kb.load()
+        self.cells = sorted(grid.values(), key=lambda e: (e['species'], COLORS.index(e['color'])))
+        self.index = {(e['species'], e['color']): i for i, e in enumerate(self.cells)}
+        species = sorted({e['species'] for e in self.cells})
+        species_idx = np.array([species.index(e['species']) for e in self.cells])
+        color_idx = np.array([COLORS.index(e['color']) for e in self.cells])
+
+        # symbolism vectors: the specific meaning counts double the generic species/color ones
+        vectors, penalties = [], []
+        for e in self.cells:
+            specific, p1 = theme_vector(e['meaning'])
+            generic, p2 = theme_vector(f"{e['species_meaning']} {e['color_meaning']}")
+            vectors.append(2 * specific + generic)
+            penalties.append(2 * p1 + p2)
+        vectors = np.stack(vectors)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.where(norms > 0, norms, 1)
+        self.penalty = np.array(penalties, dtype=np.float32)
+
+        # pair scores between every two cells: known species pairings plus color harmony
+        species_pairs = np.zeros((len(species), len(species)), dtype=np.float32)
+        for e in self.cells:
+            for p in e['pairings']:
+                species_pairs[species.index(e['species']), species.index(p['species'])] = p['score']
+        same_species = species_idx[:, None] == species_idx[None, :]
+        self.pairs = (species_pairs[species_idx[:, None], species_idx[None, :]]
+                      + 0.3 * same_species
+                      + color_harmony()[color_idx[:, None], color_idx[None, :]]) / 2
+        np.fill_diagonal(self.pairs, 0)
+
+
+    def relevance(self, text):
+        query, _ = theme_vector(text)
+        if not query.any():
+            query = np.ones_like(query)  # no recognised occasion: anything goes
+        query /= np.linalg.norm(query)
+        return self.vectors @ query - 0.5 * self.penalty
+
+
+    def recommend(self, occasion:str='', detected=(), size:int=3, count:int=3):
+        '''
+        occasion: free text, e.g. 'anniversary' or the message that goes with the bouquet
+        detected: (species, color) pairs already in hand (e.g. from the classifier), kept in every bouquet,
+        repeats count once
+        returns up to count bouquets of size flowers each, best first
+        '''
+        relevance = self.relevance(occasion)
+        # a flower detected twice would otherwise fill two slots and count its pairings twice
+        fixed = list(dict.fromkeys(self.index[key] for key in detected if key in self.index))[:size]
+
+        # prune to the most relevant cells, everything after works on a pool x pool problem
+        pool_size = min(self.pool_size, len(self.cells))
+        pool = np.argpartition(-relevance, pool_size - 1)[:pool_size]
+        pool = np.setdiff1d(pool, fixed)
+        pool_relevance = relevance[pool]
+
+        # beams are partial bouquets (rows of cell indices) with their running score
+        beams = np.array([fixed], dtype=np.int64).reshape(1, len(fixed))
+        scores = np.array([relevance[fixed].sum() + self.pair_score(fixed)], dtype=np.float32)
+
+        for _ in range(size - len(fixed)):
+            if len(pool) == 0:
+                break
+            # score adding every pool cell to every beam at once
+            gain = pool_relevance[None, :] + self.pairing_weight * self.pairs[beams][:, :, pool].sum(axis=1)
+            gain[(beams[:, :, None] == pool[None, None, :]).any(axis=1)] = -np.inf  # already in the bouquet
+            total = (scores[:, None] + gain).ravel()
+
+            keep = min(self.beam_width * 4, np.isfinite(total).sum())
+            if keep == 0:
+                break
+            best = np.argpartition(-total, keep - 1)[:keep]
+            best = best[np.argsort(-total[best])]
+            candidates = np.concatenate([beams[best // len(pool)], pool[best % len(pool), None]], axis=1)
+
+            # the same set of flowers reached in a different order is one bouquet
+            _, unique = np.unique(np.sort(candidates, axis=1), axis=0, return_index=True)
+            unique = np.sort(unique)[:self.beam_width]
+            beams, scores = candidates[unique], total[best][unique]
+
+        order = np.argsort(-scores)[:count]
+        return [{
+            'score': float(scores[i]),
+            'flowers': [{key: self.cells[c][key] for key in ('species', 'color', 'meaning')} for c in beams[i]],
+        } for i in order]
+
+
+    def pair_score(self, cells):
+        cells = np.asarray(cells, dtype=np.int64)
+        return self.pairing_weight * self.pairs[np.ix_(cells, cells)].sum() / 2
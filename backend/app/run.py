@@ -1,5 +1,19 @@
-from app import app, init_db, home
+from app import app, init_db, home, preload_model, start_model_loader
+import os
+
+# the tables are created by gunicorn.conf.py (on_starting) or below for the development server,
+# not at import: spawned ModelPool workers import this file too
+
+# with gunicorn --preload (gunicorn.conf.py) the master loads the weights before forking the workers,
+# otherwise the model loads in the background while the server already answers requests.
+# spawned ModelPool workers re-import the main script as __mp_main__, only the server loads models
+if __name__ != '__mp_main__':
+    if os.environ.get('FLOWER_PRELOAD') == '1':
+        preload_model()
+    else:
+        start_model_loader()
 
 if __name__ == '__main__':
+    # local development only, the container serves the app with gunicorn
     init_db()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000, threaded=True)
@@ -1,10 +1,91 @@
-from app import app
+import importlib
+import os
+import pytest
 
-client = app.test_client()
+PROFILE_TOKEN = 'test-token'
 
-def test():
-    response = client.get("/")
-    print(response.status_code)
-    print(response.get_json())
 
-test()
+# the app reads its paths and tokens at import, so point them at a scratch folder first
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('app')
+    env = {'FLOWER_DB': str(tmp / 'database.db'), 'FLOWER_UPLOAD_DIR': str(tmp / 'uploads'),
+           'FLOWER_CACHE_DB': '', 'FLOWER_PROFILE_TOKEN': PROFILE_TOKEN}
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        app = importlib.import_module('app')
+        app.init_db()
+        yield app.app.test_client()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def test_home(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert response.get_json() == {'message': 'Hi'}
+
+
+def test_upload_without_image(client):
+    response = client.post('/upload')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'no image uploaded'}
+
+
+def test_unknown_job(client):
+    response = client.get('/jobs/nope')
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'unknown job'}
+
+
+def test_user_uploads(client):
+    from app import db
+    for i in range(3):
+        db.record_upload(f'{i}.jpg', 7)
+
+    response = client.get('/users/7/uploads')
+    assert response.status_code == 200
+    assert [u['filename'] for u in response.get_json()['uploads']] == ['2.jpg', '1.jpg', '0.jpg']
+
+    # sqlite would read a negative limit as no limit, it is clamped to 1, a negative offset to 0
+    response = client.get('/users/7/uploads?limit=-1&offset=-5')
+    assert [u['filename'] for u in response.get_json()['uploads']] == ['2.jpg']
+    response = client.get('/users/7/uploads?limit=1&offset=2')
+    assert [u['filename'] for u in response.get_json()['uploads']] == ['0.jpg']
+
+
+def test_metrics(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'flower_request_seconds' in response.get_data(as_text=True)
+
+
+def test_ready(client):
+    # the models are never loaded here
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.get_json()['status'] in ('loading', 'failed')
+
+
+def test_recommend_bad_size(client):
+    for body in ('{"size": 1e400}', '{"size": Infinity}', '{"count": true}', '{"size": "3"}'):
+        response = client.post('/api/recommend', data=body, content_type='application/json')
+        assert response.status_code == 400, body
+        assert response.get_json() == {'error': 'size and count must be integers'}
+
+
+def test_profile_needs_token(client):
+    for method in (client.get, client.post):
+        assert method('/metrics/profile').status_code == 403
+        assert method('/metrics/profile', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+    headers = {'X-Admin-Token': PROFILE_TOKEN}
+    assert client.get('/metrics/profile', headers=headers).status_code == 200
+    response = client.post('/metrics/profile', json={'rate': 0}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['rate'] == 0.0
@@ -0,0 +1,99 @@
+# dynamic micro-batching so concurrent requests share one forward pass
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, predict_batch, max_batch_size:int=8, max_wait_ms:float=5.0, workers:int=1):
+        '''
+        predict_batch: function taking a list of inputs and returning a list of results in the same order
+        max_batch_size: most requests grouped into one call
+        max_wait_ms: how long the first request in a group waits for others to join
+        workers: batches in flight at once, more than 1 only helps when predict_batch releases
+        the GIL for its whole call (e.g. it hands the batch to a ModelPool process)
+        '''
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.queue = queue.Queue()
+        self.workers = [threading.Thread(target=self._run, name=f'micro-batcher-{i}', daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+
+    # queue one input, the returned future resolves once its group has run
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+
+    # blocking version of submit
+    def predict(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+
+    # stop the workers once everything already queued has run
+    def close(self):
+        self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+    # block for the first request, then collect more until the batch is full or the wait runs out
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            # leave the sentinel for the other workers
+            self.queue.put(None)
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # put the sentinel back so the loop stops after this batch
+                self.queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            # skip requests whose caller already gave up
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            try:
+                results = list(self.predict_batch(items))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            # a short result list would leave some callers waiting forever, so fail the whole batch instead
+            if len(results) != len(batch):
+                error = RuntimeError(f'predict_batch returned {len(results)} results for {len(batch)} inputs')
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            # fan results back out to the waiting requests
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,98 @@
+# benchmark for the mask/resize/normalize step of ClassifyFlower, old PIL path vs tensor path
+# runs offline on synthetic images: python bench_preprocess.py --runs 50
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from torch.profiler import profile, ProfilerActivity
+
+from cnn_inference import prepare_flower
+
+
+# the PIL round-trip preprocessing load_image used before prepare_flower, kept for comparison
+segmentation_transform = transforms.Compose([
+    transforms.Resize((640, 640)),
+    transforms.ToTensor(),
+])
+inference_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])
+])
+
+def legacy_prepare_flower(img_rgb, mask):
+    img_tensor = segmentation_transform(img_rgb).unsqueeze(0)
+
+    best_mask = mask.cpu().numpy()
+    mask_pil = Image.fromarray((best_mask * 255).astype(np.uint8))
+    mask_pil = mask_pil.resize((640, 640), Image.Resampling.NEAREST)
+    best_mask = np.array(mask_pil).astype(np.float32) / 255.0
+
+    binary_mask = (best_mask > 0.5).astype(np.uint8)
+    binary_mask = np.stack([binary_mask]*3, axis=-1)
+
+    img_rgb = img_tensor.squeeze(0).permute(1,2,0).cpu().numpy()
+
+    flower =  img_rgb * binary_mask
+    flower = Image.fromarray((flower * 255).astype(np.uint8))
+    return inference_transform(flower).unsqueeze(0)
+
+
+# random photo-sized image plus an elliptical mask at the segmenter's output size
+def synthetic_inputs(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    img = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+    yy, xx = torch.meshgrid(torch.linspace(-1, 1, 480), torch.linspace(-1, 1, 640), indexing='ij')
+    mask = ((xx / 0.6) ** 2 + (yy / 0.8) ** 2 <= 1).float()
+    return img, mask
+
+
+def time_per_image(fn, img, mask, runs):
+    fn(img, mask)  # warm up
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn(img, mask)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+# python-side (numpy registers with tracemalloc) and torch-side allocations for one call
+def allocations(fn, img, mask):
+    tracemalloc.start()
+    fn(img, mask)
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn(img, mask)
+    events = [e for e in prof.key_averages() if e.self_cpu_memory_usage > 0]
+    torch_bytes = sum(e.self_cpu_memory_usage for e in events)
+    torch_allocs = sum(e.count for e in events)
+    return py_peak, torch_bytes, torch_allocs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    img, mask = synthetic_inputs(args.width, args.height)
+
+    paths = {'pil (before)': legacy_prepare_flower, 'tensor (after)': prepare_flower}
+    outputs = {}
+    print(f'{"path":<16}{"ms/image":>10}{"numpy peak KiB":>16}{"torch alloc KiB":>17}{"torch allocs":>14}')
+    for name, fn in paths.items():
+        ms = time_per_image(fn, img, mask, args.runs)
+        py_peak, torch_bytes, torch_allocs = allocations(fn, img, mask)
+        outputs[name] = fn(img, mask)
+        print(f'{name:<16}{ms:>10.2f}{py_peak / 1024:>16.0f}{torch_bytes / 1024:>17.0f}{torch_allocs:>14}')
+
+    before, after = outputs.values()
+    print(f'max abs difference between outputs: {(before - after).abs().max().item():.4f}')
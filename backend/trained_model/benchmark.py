@@ -0,0 +1,224 @@
+# end-to-end benchmark for ClassifyFlower on synthetic images, runs offline and writes JSON
+# python benchmark.py --batch-sizes 1 4 8 --threads 1 4 --out bench.json
+# python benchmark.py --baseline bench.json   (compare against an earlier run)
+# without --weights/--seg both models are randomly initialized, timings match the real
+# architectures but the predictions are meaningless
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+import numpy as np
+import torch
+
+from model_init import get_model
+from cnn_inference import ClassifyFlower
+
+SEG_ARCH = 'yolov8n-seg.yaml'
+
+
+# JPEG-encoded noise photos with a bright disc in the middle, decoded like real uploads
+def synthetic_images(count, width, height, seed=0):
+    from PIL import Image, ImageDraw
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        img = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+        r = min(width, height) // 3
+        ImageDraw.Draw(img).ellipse((width // 2 - r, height // 2 - r, width // 2 + r, height // 2 + r),
+                                    fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+# stand-in for an ultralytics result with one centred detection
+class SyntheticBoxes:
+    def __init__(self, width, height):
+        self.xyxyn = torch.tensor([[1 / 6, 1 / 6, 5 / 6, 5 / 6]])
+        self.xyxy = self.xyxyn * torch.tensor([width, height, width, height])
+        self.conf = torch.tensor([0.9])
+
+    def __len__(self):
+        return 1
+
+
+class SyntheticMasks:
+    def __init__(self, data):
+        self.data = data
+
+
+class SyntheticResult:
+    def __init__(self, width, height, imgsz):
+        self.boxes = SyntheticBoxes(width, height)
+
+        # masks come back in the letterboxed frame, rounded up to the model stride
+        gain = imgsz / max(width, height)
+        mask_h, mask_w = (math.ceil(d * gain / 32) * 32 for d in (height, width))
+        yy, xx = torch.meshgrid(torch.linspace(-1, 1, mask_h), torch.linspace(-1, 1, mask_w), indexing='ij')
+        self.masks = SyntheticMasks(((xx ** 2 + yy ** 2) <= 0.4).float()[None])
+
+
+# an untrained segmenter finds nothing, so fill empty results with a synthetic detection
+# and still time the real YOLO call, otherwise mask/forward/decode would never run
+def always_detect(clfr):
+    segment = clfr.segment
+
+    def segment_or_synthetic(images):
+        results = segment(images)
+        if not isinstance(images, list):
+            images = [images]
+        return [r if len(r.boxes) else SyntheticResult(*img.size, clfr.seg_imgsz)
+                for r, img in zip(results, images)]
+    clfr.segment = segment_or_synthetic
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+    }
+
+
+# peak resident set size of this process so far, ru_maxrss is KiB on linux and bytes on macOS
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_config(clfr, images, batch_size, threads, iterations, warmup):
+    '''
+    time iterations calls of predict_batch with batch_size images each, using threads intra-op threads
+    returns latency percentiles per call, per-stage percentiles and images per second
+    '''
+    torch.set_num_threads(threads)
+    stage_times = defaultdict(list)
+    clfr.stage_hook = None
+
+    batches = [[images[(i * batch_size + j) % len(images)] for j in range(batch_size)]
+               for i in range(warmup + iterations)]
+    for batch in batches[:warmup]:
+        clfr.predict_batch(batch)
+
+    # each call's stage times are summed so stages are comparable to the call latency
+    latencies = []
+    for batch in batches[warmup:]:
+        call = defaultdict(float)
+        clfr.stage_hook = lambda name, seconds: call.__setitem__(name, call[name] + seconds)
+        start = time.perf_counter()
+        clfr.predict_batch(batch)
+        latencies.append(time.perf_counter() - start)
+        for name, seconds in call.items():
+            stage_times[name].append(seconds)
+    clfr.stage_hook = None
+
+    return {
+        'batch_size': batch_size,
+        'threads': threads,
+        'iterations': iterations,
+        'latency': percentiles(latencies),
+        'stages': {name: percentiles(stage_times[name]) for name in clfr.STAGES if name in stage_times},
+        'images_per_s': batch_size * iterations / sum(latencies),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# p50 latency and throughput of this run relative to a baseline report, matched on batch size and threads
+def compare(report, baseline):
+    old = {(r['batch_size'], r['threads']): r for r in baseline['results']}
+    print(f'baseline {baseline.get("commit")} -> {report.get("commit")}')
+    print(f'{"batch":>6}{"threads":>8}{"p50 ms":>10}{"change":>9}{"img/s":>9}{"change":>9}')
+    for r in report['results']:
+        before = old.get((r['batch_size'], r['threads']))
+        if before is None:
+            continue
+        p50, old_p50 = r['latency']['p50_ms'], before['latency']['p50_ms']
+        ips, old_ips = r['images_per_s'], before['images_per_s']
+        print(f'{r["batch_size"]:>6}{r["threads"]:>8}{p50:>10.1f}{(p50 / old_p50 - 1) * 100:>+8.1f}%'
+              f'{ips:>9.1f}{(ips / old_ips - 1) * 100:>+8.1f}%')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', default=None, help='classifier weights, random if omitted')
+    parser.add_argument('--seg', default=SEG_ARCH, help='YOLO weights, random yolov8n-seg if omitted')
+    parser.add_argument('--crop-mode', default='mask', choices=['mask', 'box'])
+    parser.add_argument('--seg-imgsz', type=int, default=640)
+    parser.add_argument('--decode-size', type=int, default=None, help='see ClassifyFlower, 0 decodes at full resolution')
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--images', type=int, default=16, help='distinct synthetic images to cycle through')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', default=None, help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', default=None, help='earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    load_start = time.perf_counter()
+    clfr = ClassifyFlower(get_model, args.weights, args.seg, crop_mode=args.crop_mode, seg_imgsz=args.seg_imgsz,
+                          decode_size=args.decode_size)
+    load_s = time.perf_counter() - load_start
+    always_detect(clfr)
+    images = synthetic_images(args.images, args.width, args.height)
+
+    results = []
+    for threads in sorted(set(args.threads)):
+        for batch_size in args.batch_sizes:
+            results.append(run_config(clfr, images, batch_size, threads, args.iterations, args.warmup))
+            r = results[-1]
+            print(f'batch {batch_size:>3} threads {threads:>3}: p50 {r["latency"]["p50_ms"]:.1f} ms, '
+                  f'{r["images_per_s"]:.1f} img/s', file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'device': clfr.device,
+            'cpu_count': os.cpu_count(),
+            'machine': platform.machine(),
+        },
+        'config': {
+            'weights': args.weights,
+            'seg': args.seg,
+            'crop_mode': args.crop_mode,
+            'seg_imgsz': args.seg_imgsz,
+            'decode_size': clfr.decode_size,
+            'image_size': [args.width, args.height],
+            'warmup': args.warmup,
+        },
+        'model_load_s': load_s,
+        'peak_rss_mb': peak_rss_mb(),
+        'results': results,
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
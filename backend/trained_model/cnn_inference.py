@@ -1,47 +1,165 @@
 # class to call for inference on an uploaded image
+import io
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 import numpy as np
 import torch
-from PIL import Image
-from ultralytics import YOLO
-from torchvision import transforms
+import torch.nn.functional as F
+from PIL import Image, ImageOps
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=UserWarning)
 from model_init import get_model
+from prediction_cache import content_key, file_version, stream_key
+from export_model import load_engine
+
+
+# imagenet stats, folded so normalizing a uint8 pixel is one multiply and one subtract:
+# (x / 255 - mean) / std == x * scale - shift
+IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+NORM_SCALE = 1.0 / (255.0 * IMAGENET_STD)
+NORM_SHIFT = IMAGENET_MEAN / IMAGENET_STD
+
+
+# grow a normalized (x1, y1, x2, y2) box by padding * its size on each side, clamped to the frame
+def pad_box(box, padding:float=0.1):
+    x1, y1, x2, y2 = (float(v) for v in box)
+    pad_x, pad_y = (x2 - x1) * padding, (y2 - y1) * padding
+    return max(0.0, x1 - pad_x), max(0.0, y1 - pad_y), min(1.0, x2 + pad_x), min(1.0, y2 + pad_y)
+
+
+# pixel bounds of a normalized box in a width x height frame, at least one pixel wide
+def box_pixels(box, width, height):
+    x1, y1, x2, y2 = box
+    left, top = min(int(x1 * width), width - 1), min(int(y1 * height), height - 1)
+    right, bottom = max(int(round(x2 * width)), left + 1), max(int(round(y2 * height)), top + 1)
+    return left, top, right, bottom
+
+
+def prepare_flower(img_rgb, mask, size:int=224, device='cpu', box=None):
+    '''
+    tensor-native preprocessing: crop, resize once, mask, normalize in place
+    img_rgb: PIL image at any resolution
+    mask: (h, w) mask from the segmentation model, 1 where the flower is
+    box: optional normalized (x1, y1, x2, y2) region to crop both image and mask to first
+    returns a normalized (1, 3, size, size) float tensor with the background zeroed
+    '''
+    # the mask lives in the segmenter's letterboxed frame: the image scaled by gain and centred,
+    # padded to the stride (or to a square for mixed-shape batches). without a box the whole
+    # image is mapped, so the padding is cut off instead of being stretched over the flower
+    width, height = img_rgb.size
+    mask_h, mask_w = mask.shape
+    gain = min(mask_h / height, mask_w / width)
+    pad_x, pad_y = (mask_w - width * gain) / 2, (mask_h - height * gain) / 2
+    x1, y1, x2, y2 = box if box is not None else (0.0, 0.0, 1.0, 1.0)
+    mask_box = ((x1 * width * gain + pad_x) / mask_w, (y1 * height * gain + pad_y) / mask_h,
+                (x2 * width * gain + pad_x) / mask_w, (y2 * height * gain + pad_y) / mask_h)
+
+    # crop the full-resolution image so the flower keeps all of its pixels,
+    # the mask is sliced in its own frame (a view, no copy)
+    if box is not None:
+        img_rgb = img_rgb.crop(box_pixels(box, width, height))
+    left, top, right, bottom = box_pixels(mask_box, mask_w, mask_h)
+    mask = mask[top:bottom, left:right]
+
+    # resized once to the classifier size while still uint8 (PIL's antialiased bilinear),
+    # resizing the full-resolution tensor would cast all of it to float first
+    # (HWC uint8 -> 1CHW, what torchvision's pil_to_tensor does, without importing torchvision)
+    img = img_rgb.resize((size, size), Image.Resampling.BILINEAR)
+    img = torch.from_numpy(np.array(img)).permute(2, 0, 1).unsqueeze(0).to(device)
+
+    mask = F.interpolate(mask[None, None].float(), size=(size, size), mode='nearest').to(device)
+
+    # the only float copy of the image, at classifier size; everything after is in place
+    flower = img.to(torch.float32).mul_(mask > 0.5)
+    return flower.mul_(NORM_SCALE.to(device)).sub_(NORM_SHIFT.to(device))
+
+
+# calls hook(name, seconds) once the wrapped block finishes, syncing cuda so kernels are counted
+@contextmanager
+def timed_stage(hook, name, device='cpu'):
+    start = time.perf_counter()
+    yield
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    hook(name, time.perf_counter() - start)
+
+
+# segmentation models are shared by every ClassifyFlower in the process,
+# keyed by weights path, so YOLO is only deserialized once
+_seg_models = {}
+_seg_models_lock = threading.Lock()
+
+
+def get_seg_model(seg_path):
+    '''
+    returns (model, lock) for the YOLO weights at seg_path, building it on first use.
+    ultralytics predictors keep per-call state, so callers hold the lock while predicting
+    '''
+    with _seg_models_lock:
+        if seg_path not in _seg_models:
+            # imported here so preprocessing/benchmark users of this module don't pay for ultralytics
+            from ultralytics import YOLO
+            seg_model = YOLO(seg_path)
+            seg_model.eval()
+            _seg_models[seg_path] = (seg_model, threading.Lock())
+        return _seg_models[seg_path]
 
 
 class ClassifyFlower:
+    # pipeline stages reported to stage_hook, in the order they run
+    STAGES = ('image_decode', 'segmentation', 'mask_resize', 'forward', 'label_decode')
+
     def __init__(self, 
                  model_arch, 
                  weights_path:str='test1.2_best_model.pt', 
-                 seg_path:str='flowers_segmentation_model.pt'):
+                 seg_path:str='flowers_segmentation_model.pt',
+                 warmup:bool=False,
+                 crop_mode:str='mask',
+                 box_padding:float=0.1,
+                 seg_imgsz:int=640,
+                 cache=None,
+                 stage_hook=None,
+                 mmap:bool=False,
+                 decode_size:int=None):
         '''
         model_arch: function for returning model instance/architecture
-        model_weights: PATH to the model's weights
+        model_weights: PATH to the model's weights, a state dict or an artifact from export_model.py, None for random weights
         seg_path: PATH to the pretrained YOLO model for image segmentation/masking
+        warmup: run one dummy image through both models so the first real request is not slow
+        crop_mode: 'mask' masks the whole frame (original behaviour), 'box' crops to the detected box first
+        box_padding: fraction of the box size added on each side in 'box' mode
+        seg_imgsz: input size for the segmentation model, 'box' mode holds up at smaller sizes
+        cache: optional PredictionCache, repeated images skip both models
+        stage_hook: optional hook(stage, seconds) called after each pipeline stage, see STAGES
+        mmap: memory-map the classifier weights on CPU so processes loading the same file share them
+        decode_size: shortest side large photos are decoded down to, None picks seg_imgsz ('mask')
+        or 2 * seg_imgsz ('box', the crop still needs detail), 0 always decodes at full resolution
         '''
+        if crop_mode not in ('mask', 'box'):
+            raise ValueError(f"crop_mode must be 'mask' or 'box', got {crop_mode!r}")
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-        # initialize trained model
-        self.model = model_arch().to(self.device)
-        self.model.load_state_dict(torch.load(weights_path))
-        self.model.eval()
+        # initialize trained model, exported .ts/.onnx artifacts run on the CPU
+        self.model, self.device = load_engine(model_arch, weights_path, self.device, mmap)
 
         self.seg_path = seg_path # path to segmentation model
+        self.seg_model, self.seg_lock = get_seg_model(seg_path)
         
-        # image transformations for segmentation model
-        self.segmentation_transform = transforms.Compose([
-            transforms.Resize((640, 640)),
-            transforms.ToTensor(),
-        ])
-
-        # image transformations for inference model
-        self.inference_transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
-        ])
+        self.input_size = 224 # classifier input resolution
+        self.crop_mode = crop_mode
+        self.box_padding = box_padding
+        self.seg_imgsz = seg_imgsz
+        if decode_size is None:
+            decode_size = seg_imgsz if crop_mode == 'mask' else 2 * seg_imgsz
+        self.decode_size = decode_size
+
+        # cached results are only valid for these weights and preprocessing settings
+        self.cache = cache
+        if cache is not None:
+            self.version = f'{file_version(weights_path, seg_path)}:{crop_mode}:{box_padding}:{seg_imgsz}:{decode_size}'
 
         # dictionary for decoding predictions
         self.decode_species = {
@@ -53,65 +171,278 @@ class ClassifyFlower:
             0: 'white', 1: 'yellow', 2: 'orange', 3: 'pink', 4: 'red', 5: 'purple', 6: 'maroon', 7: 'brown'
         }
 
+        self.stage_hook = stage_hook
+
+        if warmup:
+            self.warmup()
+
+
+    # time a block as one of STAGES when a stage hook is set, free otherwise
+    def stage(self, name):
+        if self.stage_hook is None:
+            return nullcontext()
+        return timed_stage(self.stage_hook, name, self.device)
+
+
+    # push a blank image through both models to trigger lazy init (fusing, allocator, kernels)
+    @torch.no_grad()
+    def warmup(self):
+        blank = Image.new('RGB', (self.seg_imgsz, self.seg_imgsz))
+        self.segment(blank)
+        self.model(torch.zeros(1, 3, self.input_size, self.input_size, device=self.device))
+
+
+    def read_image(self, image):
+        '''
+        decode an image path, raw bytes, binary stream or PIL image (.png, .jpg, etc.) to an upright RGB image
+        JPEGs (and MPO, the multi-frame JPEG some phones save) are decoded straight at 1/2, 1/4 or 1/8 scale
+        (draft mode) when that still leaves decode_size pixels on the short side, anything else far above it
+        is box-reduced, so 12-48 MP photos never sit in memory at full resolution
+        returns (image, scale), scale maps pixels of the returned image back to the original's
+        '''
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+        opened = not isinstance(image, Image.Image)
+        img = Image.open(image) if opened else image
+        full_size = max(img.size)
+
+        # draft only has an effect before the pixels are loaded
+        if self.decode_size and img.format in ('JPEG', 'MPO'):
+            img.draft('RGB', (self.decode_size, self.decode_size))
+
+        # phones store portrait photos sideways with an orientation tag
+        if opened:
+            ImageOps.exif_transpose(img, in_place=True)
+        else:
+            img = ImageOps.exif_transpose(img)
+
+        # before reducing: reduce() raises on palette ('P') and bilevel images
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if self.decode_size:
+            factor = min(img.size) // self.decode_size
+            if factor >= 2:
+                img = img.reduce(factor)
+
+        img.load()  # decode here, not lazily inside the segmentation stage
+        return img, full_size / max(img.size)
+
+
+    # decoded RGB image only, see read_image
+    def open_image(self, image):
+        return self.read_image(image)[0]
+
+
+    # cache key for an image path, raw bytes, binary stream or PIL image under the current model version
+    # files and streams are hashed in chunks, so a large upload is never read into memory whole
+    def cache_key(self, image, kind:str='single'):
+        version = f'{self.version}:{kind}'
+        if isinstance(image, Image.Image):
+            return content_key(f'{image.mode}{image.size}'.encode() + image.tobytes(), version)
+        if isinstance(image, bytes):
+            return content_key(image, version)
+        if hasattr(image, 'read'):
+            # hash the stream and rewind it for the decoder
+            start = image.tell()
+            key = stream_key(image, version)
+            image.seek(start)
+            return key
+        with open(image, 'rb') as f:
+            return stream_key(f, version)
+
+
+    # cached (species, color) for an image, None if it has not been seen or there is no cache
+    def cached_prediction(self, image):
+        if self.cache is None:
+            return None
+        pred = self.cache.get(self.cache_key(image), count_miss=False)
+        return tuple(pred) if pred is not None else None
+
+
+    # run the segmentation model over a list of PIL images in one batched call
+    def segment(self, images):
+        # threshold is 15% confidence
+        with self.seg_lock:
+            return self.seg_model.predict(images, conf=0.15, imgsz=self.seg_imgsz, save=False, show=False, verbose=False)
+
+
+    # preprocess detection idx of a segmentation result into a classifier input
+    def prepare_detection(self, img_rgb, r, idx):
+        box = None
+        if self.crop_mode == 'box':
+            box = pad_box(r.boxes.xyxyn[idx].tolist(), self.box_padding)
+        return prepare_flower(img_rgb, r.masks.data[idx], self.input_size, self.device, box)
+
+
+    # mask the flower out of one image using its segmentation result, None if nothing was found
+    def mask_flower(self, img_rgb, r):
+        if len(r.boxes) == 0:
+            return None
+
+        # highest scoring mask
+        idx_max = r.boxes.conf.argmax()
+        return self.prepare_detection(img_rgb, r, idx_max)
+
 
     # preprocess image
     def load_image(self, image_path):
         error = False
 
-        # load pretrained segmentation model
-        seg_model = YOLO(self.seg_path)
-        seg_model.eval()
-        
-        # load image, prep for processing (Image supports .png, .jpg, etc.)
-        img_rgb = Image.open(image_path).convert('RGB')
-        img_tensor = self.segmentation_transform(img_rgb).unsqueeze(0)
+        with self.stage('image_decode'):
+            img_rgb = self.open_image(image_path)
+        with self.stage('segmentation'):
+            r = self.segment(img_rgb)[0]
 
-        # preprocess - threshold is 15% confidence
-        results = seg_model.predict(img_rgb, conf=0.15, save=False, show=False, verbose=False)
-        r = results[0]
-        if len(r.boxes) == 0:
+        with self.stage('mask_resize'):
+            flower = self.mask_flower(img_rgb, r)
+        if flower is None:
             print("No flowers here, fam")
             error = True
             return None, error
 
-        # identify highest scoring mask, create binary mask
-        scores = r.boxes.conf.cpu().numpy()
-        idx_max = scores.argmax()
-        best_mask = r.masks.data[idx_max].cpu().numpy()
-        mask_pil = Image.fromarray((best_mask * 255).astype(np.uint8))
-        mask_pil = mask_pil.resize((640, 640), Image.Resampling.NEAREST)
-        best_mask = np.array(mask_pil).astype(np.float32) / 255.0
-
-        binary_mask = (best_mask > 0.5).astype(np.uint8)
-        binary_mask = np.stack([binary_mask]*3, axis=-1)
-
-        img_rgb = img_tensor.squeeze(0).permute(1,2,0).cpu().numpy()
+        return flower, error
 
-        # apply mask
-        flower =  img_rgb * binary_mask
-        flower = Image.fromarray((flower * 255).astype(np.uint8))
-        flower = self.inference_transform(flower).unsqueeze(0).to(self.device)
 
-        return flower, error
+    # turn a batch of logits into (species, color) names
+    def decode(self, species_logits, color_logits):
+        species_pred = species_logits.argmax(dim=1).tolist()
+        color_pred = color_logits.argmax(dim=1).tolist()
+        return [(self.decode_species[s], self.decode_color[c]) for s, c in zip(species_pred, color_pred)]
 
     
     @torch.no_grad()
     def predict(self, image_path):
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(image_path)
+            pred = self.cache.get(key)
+            if pred is not None:
+                return tuple(pred)
+
         # run inference on single image
         tensor, error = self.load_image(image_path)
 
         if error == True:
             print(f'error: no flower was detected')
-            return None, None
+            pred = None, None
         else:
-            species_logits, color_logits = self.model(tensor)
-            _, species_pred = torch.max(species_logits, dim=1)
-            _, color_pred = torch.max(color_logits, dim=1)
+            with self.stage('forward'):
+                species_logits, color_logits = self.model(tensor)
+            with self.stage('label_decode'):
+                pred = self.decode(species_logits, color_logits)[0]
+
+        if key is not None:
+            self.cache.put(key, list(pred))
+        return pred
+
+
+    @torch.no_grad()
+    def predict_batch(self, paths_or_images):
+        '''
+        paths_or_images: list of image paths, raw image bytes, binary streams and/or PIL images
+        returns a list of (species, color) in the same order, (None, None) where no flower was detected
+        '''
+        preds = [(None, None)] * len(paths_or_images)
+
+        # only images missing from the cache go through the models, and identical images only once
+        todo = list(range(len(paths_or_images)))
+        keys = {}
+        copies = {}  # index -> earlier index with the same content
+        if self.cache is not None:
+            todo = []
+            first = {}
+            for i, image in enumerate(paths_or_images):
+                key = keys[i] = self.cache_key(image)
+                if key in first:
+                    copies[i] = first[key]
+                    continue
+                first[key] = i
+                pred = self.cache.get(key)
+                if pred is None:
+                    todo.append(i)
+                else:
+                    preds[i] = tuple(pred)
+        if todo:
+            self.predict_uncached(paths_or_images, todo, preds)
+            for i in todo:
+                if i in keys:
+                    self.cache.put(keys[i], list(preds[i]))
+        for i, j in copies.items():
+            preds[i] = preds[j]
+        return preds
+
+
+    # fill preds[i] for each i in todo, one segmentation call and one classifier call for all of them
+    def predict_uncached(self, paths_or_images, todo, preds):
+        with self.stage('image_decode'):
+            images = [self.open_image(paths_or_images[i]) for i in todo]
+
+        with self.stage('segmentation'):
+            results = self.segment(images)
+        with self.stage('mask_resize'):
+            flowers = [self.mask_flower(img_rgb, r) for img_rgb, r in zip(images, results)]
+
+        found = [j for j, flower in enumerate(flowers) if flower is not None]
+        if found:
+            with self.stage('forward'):
+                batch = torch.cat([flowers[j] for j in found])
+                species_logits, color_logits = self.model(batch)
+            with self.stage('label_decode'):
+                decoded = self.decode(species_logits, color_logits)
+            for j, pred in zip(found, decoded):
+                preds[todo[j]] = pred
+
+
+    @torch.no_grad()
+    def predict_bouquet(self, image):
+        '''
+        classify every flower detected in one image (path, raw bytes, stream or PIL image), not just the best one
+        returns a list of dicts with species, color, their softmax confidences, the detection
+        confidence and the box in image pixels, highest detection confidence first
+        '''
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(image, 'bouquet')
+            flowers = self.cache.get(key)
+            if flowers is not None:
+                return flowers
+
+        with self.stage('image_decode'):
+            img_rgb, scale = self.read_image(image)
+        with self.stage('segmentation'):
+            r = self.segment(img_rgb)[0]
+        if len(r.boxes) == 0:
+            if key is not None:
+                self.cache.put(key, [])
+            return []
+
+        order = r.boxes.conf.argsort(descending=True).tolist()
+        with self.stage('mask_resize'):
+            batch = torch.cat([self.prepare_detection(img_rgb, r, idx) for idx in order])
+
+        # all crops share one forward pass
+        with self.stage('forward'):
+            species_logits, color_logits = self.model(batch)
+        with self.stage('label_decode'):
+            species_conf, species_pred = species_logits.softmax(dim=1).max(dim=1)
+            color_conf, color_pred = color_logits.softmax(dim=1).max(dim=1)
 
-            species_pred = self.decode_species[species_pred.item()]
-            color_pred = self.decode_color[color_pred.item()]
+            det_conf = r.boxes.conf[order].tolist()
+            # boxes in the original photo's pixels, not the reduced decode's
+            boxes = (r.boxes.xyxy[order] * scale).tolist()
+            flowers = [{
+                'species': self.decode_species[s],
+                'color': self.decode_color[c],
+                'species_confidence': sc,
+                'color_confidence': cc,
+                'confidence': dc,
+                'box': box,
+            } for s, c, sc, cc, dc, box in zip(species_pred.tolist(), color_pred.tolist(),
+                                               species_conf.tolist(), color_conf.tolist(), det_conf, boxes)]
 
-            return species_pred, color_pred
+        if key is not None:
+            self.cache.put(key, flowers)
+        return flowers
 
 
 ### example use
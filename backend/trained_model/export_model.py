@@ -0,0 +1,190 @@
+# export a trained SimpleResnet state dict to an optimized CPU artifact, and load artifacts back
+# python export_model.py test1.2_best_model.pt --mode int8-static --calib-dir ../../model_training/data/flowers/rose
+# (calibration and parity images are segmented with --seg-weights first, like served uploads)
+import argparse
+import os
+import time
+import torch
+
+from model_init import get_model
+
+# no dynamic int8 mode: it only reaches the two small Linear heads, ResNet50's convs stay fp32,
+# so it saved ~1% of the file and no time
+MODES = ('fp32', 'int8-static', 'onnx')
+
+
+# onnxruntime session behind the same call signature as SimpleResnet
+class OnnxEngine:
+    def __init__(self, path):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError('loading .onnx weights needs onnxruntime (pip install onnxruntime)') from e
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x):
+        species_logits, color_logits = self.session.run(None, {'image': x.cpu().numpy()})
+        return torch.from_numpy(species_logits), torch.from_numpy(color_logits)
+
+    def eval(self):
+        return self
+
+
+def load_engine(model_arch, weights_path, device, mmap:bool=False):
+    '''
+    load weights_path as something callable like SimpleResnet
+    .ts/.onnx files are exported CPU artifacts, anything else is a state dict for model_arch,
+    None leaves model_arch randomly initialized (benchmarks without trained weights)
+    mmap: on CPU, memory-map a state dict instead of reading it, see below
+    returns (model, device it runs on)
+    '''
+    if weights_path is None:
+        return model_arch().to(device).eval(), device
+    if weights_path.endswith('.ts'):
+        # optimize_for_inference (conv/relu fusion, mkldnn) runs after loading, its output can't be saved
+        return torch.jit.optimize_for_inference(torch.jit.load(weights_path, map_location='cpu').eval()), 'cpu'
+    if weights_path.endswith('.onnx'):
+        return OnnxEngine(weights_path), 'cpu'
+
+    if mmap and device == 'cpu':
+        # build on the meta device (no random init) and assign the mapped tensors as the parameters,
+        # so every process mapping the same file reads one copy of the weights from the page cache
+        with torch.device('meta'):
+            model = model_arch()
+        model.load_state_dict(torch.load(weights_path, map_location='cpu', mmap=True), assign=True)
+        return model.eval(), device
+
+    model = model_arch().to(device)
+    model.load_state_dict(torch.load(weights_path, map_location=device))
+    return model.eval(), device
+
+
+def sample_inputs(image_dir, seg_path, start:int=0, count:int=32, crop_mode:str='mask', seg_imgsz:int=640):
+    '''
+    classifier inputs from the real images in image_dir, in name order, preprocessed exactly as
+    ClassifyFlower serves them: decoded, segmented by the YOLO model at seg_path and masked/cropped
+    to the best detection, so int8 ranges are calibrated on segmented flowers with the background zeroed
+    start/count pick a slice, so calibration and the parity check can use different images,
+    images without a detected flower are skipped
+    '''
+    from cnn_inference import ClassifyFlower
+    names = sorted(n for n in os.listdir(image_dir) if n.lower().endswith(('.jpg', '.jpeg', '.png')))
+    names = names[start:start + count]
+    if not names:
+        raise ValueError(f'no images in {image_dir} after the first {start}')
+
+    # only the preprocessing is used, the classifier weights don't matter
+    clfr = ClassifyFlower(get_model, None, seg_path, crop_mode=crop_mode, seg_imgsz=seg_imgsz)
+    inputs = []
+    for n in names:
+        flower, error = clfr.load_image(os.path.join(image_dir, n))
+        if not error:
+            inputs.append(flower)
+    if not inputs:
+        raise ValueError(f'no flower detected in {image_dir}/{names[0]}..{names[-1]}')
+    return inputs
+
+
+# torchscript + freeze folds batchnorm into the convs, conv/relu fusion happens in load_engine
+def freeze(model, example):
+    traced = torch.jit.trace(model, example)
+    return torch.jit.freeze(traced.eval())
+
+
+def export_model(model, mode, out_path, calib_inputs):
+    model = model.eval()
+    example = calib_inputs[0]
+
+    if mode == 'fp32':
+        freeze(model, example).save(out_path)
+
+    elif mode == 'int8-static':
+        # FX graph mode fuses conv-bn-relu and quantizes the whole backbone with calibrated ranges
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        prepared = prepare_fx(model, get_default_qconfig_mapping('x86'), (example,))
+        for x in calib_inputs:
+            prepared(x)
+        quantized = convert_fx(prepared)
+        freeze(quantized, example).save(out_path)
+
+    elif mode == 'onnx':
+        torch.onnx.export(model, example, out_path,
+                          input_names=['image'], output_names=['species_logits', 'color_logits'],
+                          dynamic_axes={'image': {0: 'batch'}, 'species_logits': {0: 'batch'}, 'color_logits': {0: 'batch'}},
+                          do_constant_folding=True)
+
+    else:
+        raise ValueError(f'mode must be one of {MODES}, got {mode!r}')
+
+
+# compare an exported engine against the fp32 model on the same inputs
+def check_parity(reference, engine, inputs):
+    agree_species, agree_color, max_diff = 0, 0, 0.0
+    ref_time, engine_time = 0.0, 0.0
+    for x in inputs:
+        start = time.perf_counter()
+        ref_species, ref_color = reference(x)
+        ref_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        species, color = engine(x)
+        engine_time += time.perf_counter() - start
+
+        agree_species += (species.argmax(dim=1) == ref_species.argmax(dim=1)).sum().item()
+        agree_color += (color.argmax(dim=1) == ref_color.argmax(dim=1)).sum().item()
+        max_diff = max(max_diff, (species - ref_species).abs().max().item(), (color - ref_color).abs().max().item())
+
+    total = sum(x.size(0) for x in inputs)
+    return {
+        'species_agreement': agree_species / total,
+        'color_agreement': agree_color / total,
+        'max_logit_diff': max_diff,
+        'fp32_ms': ref_time / len(inputs) * 1000,
+        'engine_ms': engine_time / len(inputs) * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', help='trained state dict, e.g. test1.2_best_model.pt')
+    parser.add_argument('--mode', choices=MODES, default='int8-static')
+    parser.add_argument('--out', help='artifact path, defaults to <weights>.<mode>.ts/.onnx')
+    parser.add_argument('--calib-dir', required=True,
+                        help='folder of flower images, the first --calib-count calibrate int8-static, '
+                             'the next --parity-count are held out for the parity check')
+    parser.add_argument('--seg-weights', default='flowers_segmentation_model.pt',
+                        help='YOLO segmentation weights the served classifier masks flowers with')
+    parser.add_argument('--crop-mode', choices=('mask', 'box'), default='mask', help='the crop mode it is served with')
+    parser.add_argument('--seg-imgsz', type=int, default=640)
+    parser.add_argument('--calib-count', type=int, default=32)
+    parser.add_argument('--parity-count', type=int, default=32)
+    parser.add_argument('--min-agreement', type=float, default=0.98)
+    args = parser.parse_args()
+
+    out_path = args.out or f"{os.path.splitext(args.weights)[0]}.{args.mode}.{'onnx' if args.mode == 'onnx' else 'ts'}"
+
+    torch.set_grad_enabled(False)
+    reference, _ = load_engine(get_model, args.weights, 'cpu')
+    calib_inputs = sample_inputs(args.calib_dir, args.seg_weights, 0, args.calib_count, args.crop_mode, args.seg_imgsz)
+    parity_inputs = sample_inputs(args.calib_dir, args.seg_weights, args.calib_count, args.parity_count,
+                                  args.crop_mode, args.seg_imgsz)
+
+    export_model(reference, args.mode, out_path, calib_inputs)
+    # a fresh fp32 copy, FX preparation can modify the module it is given
+    reference, _ = load_engine(get_model, args.weights, 'cpu')
+    engine, _ = load_engine(get_model, out_path, 'cpu')
+    parity = check_parity(reference, engine, parity_inputs)
+
+    print(f'saved {out_path} ({os.path.getsize(out_path) / 1e6:.1f} MB, '
+          f'fp32 state dict {os.path.getsize(args.weights) / 1e6:.1f} MB)')
+    for name, value in parity.items():
+        print(f'  {name}: {value:.4f}')
+
+    if min(parity['species_agreement'], parity['color_agreement']) < args.min_agreement:
+        print(f'\033[31m parity check failed: agreement below {args.min_agreement}\033[0m')
+        raise SystemExit(1)
@@ -1,12 +1,12 @@
 import torch
 import torch.nn as nn
-from torchvision import models
 
 # resnet
 class SimpleResnet(nn.Module):
     def __init__(self, num_species, num_colors):
         super().__init__()
-        # load ResNet50
+        # load ResNet50, torchvision is imported here so importing the inference code stays fast
+        from torchvision import models
         self.backbone = models.resnet50(pretrained=False)
 
         # change classification head with the identity
@@ -0,0 +1,278 @@
+# ClassifyFlower in a pool of worker processes, so PIL decode, mask work and result decoding
+# are not serialized on one interpreter's GIL. each worker maps the classifier weights from the
+# same file (torch.load(mmap=True)), so N workers share one copy of ResNet50 in the page cache
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# methods of ClassifyFlower a pool caller may run in a worker
+METHODS = ('predict', 'predict_batch', 'predict_bouquet')
+
+
+def serve(index, tasks, results, threads, classifier_kwargs, cache_args):
+    '''
+    worker process main loop: load ClassifyFlower, report ready, then run (task_id, method, args)
+    tasks until a None arrives. every reply carries this worker's index, its stage timings and cache stats
+    '''
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from cnn_inference import ClassifyFlower
+    from model_init import get_model
+    from prediction_cache import PredictionCache
+
+    stages = []
+    try:
+        cache = PredictionCache(*cache_args) if cache_args is not None else None
+        clfr = ClassifyFlower(get_model, warmup=True, cache=cache, mmap=True,
+                              stage_hook=lambda name, seconds: stages.append((name, seconds)),
+                              **classifier_kwargs)
+    except Exception as e:
+        results.put((index, None, 'failed', (os.getpid(), f'{type(e).__name__}: {e}')))
+        return
+    results.put((index, None, 'ready', os.getpid()))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, method, args = task
+        stages.clear()
+        try:
+            result = getattr(clfr, method)(*args)
+            status = 'ok'
+        except Exception as e:
+            result, status = f'{type(e).__name__}: {e}', 'error'
+        stats = clfr.cache.stats() if clfr.cache is not None else None
+        results.put((index, task_id, status, (result, list(stages), stats)))
+
+
+class ModelPool:
+    def __init__(self, workers:int, threads:int=None, stage_hook=None, cache_args=None, **classifier_kwargs):
+        '''
+        workers: number of model processes
+        threads: torch intra-op threads per process, defaults to splitting the cores evenly
+        stage_hook: hook(stage, seconds) called in this process with each worker's stage timings
+        cache_args: (max_entries, db_path) for a PredictionCache in each worker, None for no cache
+        classifier_kwargs: passed to ClassifyFlower (weights_path, seg_path, crop_mode, ...),
+        the classifier weights must be a state dict saved by torch.save (zip format) to be mapped
+        '''
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.stage_hook = stage_hook
+        self.cache_args = cache_args
+        self.classifier_kwargs = classifier_kwargs
+
+        # spawn, not fork: the web server has threads running, and torch must start fresh in each worker
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.next_id = 0
+        self.closing = False
+
+        self.ready = threading.Event()
+        self.ready_count = 0
+        self.error = None
+        self.cache_stats_by_worker = {}
+
+        self.workers = [self._start_worker(i) for i in range(workers)]
+        self.reader = threading.Thread(target=self._read_results, name='model-pool-results', daemon=True)
+        self.reader.start()
+
+        # runs before multiprocessing's own exit handler kills the workers, which would look like crashes
+        atexit.register(self.close)
+
+
+    def _start_worker(self, index):
+        tasks = self.context.Queue()
+        process = self.context.Process(target=serve, name=f'flower-model-{index}', daemon=True,
+                                       args=(index, tasks, self.results, self.threads,
+                                             self.classifier_kwargs, self.cache_args))
+        process.start()
+        # started: it reported ready. failed: the worker's error once it could not load the models,
+        # it takes no more tasks. retired: a dead worker that was not restarted and whose requests have been failed
+        return {'process': process, 'tasks': tasks, 'inflight': set(), 'started': False, 'failed': None,
+                'retired': False}
+
+
+    # block until every worker has loaded its models, raises if one could not
+    def wait_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise TimeoutError('model workers did not start in time')
+        if self.error is not None:
+            raise RuntimeError(f'model worker failed to start: {self.error}')
+
+
+    # same role as ClassifyFlower.warmup, workers warm up as they start
+    def warmup(self):
+        self.wait_ready()
+
+
+    # run method(*args) on the least busy live worker, the returned future resolves with its result
+    def submit(self, method, *args):
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {METHODS}, got {method!r}')
+        future = Future()
+        with self.lock:
+            if self.closing:
+                raise RuntimeError('model pool is closed')
+            live = [w for w in self.workers if w['failed'] is None and w['process'].is_alive()]
+            if not live:
+                raise RuntimeError('no model worker is running')
+            task_id = self.next_id
+            self.next_id += 1
+            worker = min(live, key=lambda w: len(w['inflight']))
+            worker['inflight'].add(task_id)
+            self.futures[task_id] = future
+        worker['tasks'].put((task_id, method, args))
+        return future
+
+
+    def call(self, method, *args, timeout=None):
+        return self.submit(method, *args).result(timeout=timeout)
+
+
+    def predict_batch(self, paths_or_images):
+        return self.call('predict_batch', paths_or_images)
+
+
+    def predict_bouquet(self, image):
+        return self.call('predict_bouquet', image)
+
+
+    # workers check their own caches, there is no shared in-process fast path
+    def cached_prediction(self, image):
+        return None
+
+
+    # prediction cache counters summed over the workers' latest reports
+    def cache_stats(self):
+        with self.lock:
+            reports = list(self.cache_stats_by_worker.values())
+        if not reports:
+            return None
+        stats = {key: sum(r[key] for r in reports) for key in ('hits', 'disk_hits', 'misses')}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+    def close(self):
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        live = [w for w in self.workers if not w['retired']]
+        for worker in live:
+            worker['tasks'].put(None)
+        for worker in live:
+            worker['process'].join(timeout=10)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+
+    def _read_results(self):
+        last_check = time.monotonic()
+        while True:
+            # look for crashed workers about once a second, busy or not
+            if time.monotonic() - last_check >= 1.0:
+                self._replace_dead_workers()
+                last_check = time.monotonic()
+            try:
+                message = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if self.closing:
+                    return
+                continue
+            self._handle_result(*message)
+
+
+    def _handle_result(self, index, task_id, status, payload):
+        if task_id is None:
+            self._worker_started(index, status, payload)
+            return
+
+        with self.lock:
+            self.workers[index]['inflight'].discard(task_id)
+            future = self.futures.pop(task_id, None)
+        if future is None:
+            return
+
+        result, stages, stats = payload
+        if stats is not None:
+            with self.lock:
+                self.cache_stats_by_worker[index] = stats
+        if self.stage_hook is not None:
+            for name, seconds in stages:
+                self.stage_hook(name, seconds)
+
+        if status == 'error':
+            future.set_exception(RuntimeError(result))
+        else:
+            future.set_result(result)
+
+
+    def _worker_started(self, index, status, payload):
+        if status == 'failed':
+            pid, payload = payload
+            with self.lock:
+                worker = self.workers[index]
+                if worker['process'].pid != pid:
+                    return  # from a worker that has been replaced already
+                worker['failed'] = payload
+            # only a failure while the pool starts fails the pool, a restarted worker that can't
+            # load (e.g. out of memory) is just left out of dispatch
+            if not self.ready.is_set():
+                self.error = payload
+                self.ready.set()
+            return
+        with self.lock:
+            worker = self.workers[index]
+            if worker['process'].pid != payload:
+                return
+            worker['started'] = True
+        self.ready_count += 1
+        if self.ready_count >= len(self.workers):
+            self.ready.set()
+
+
+    # a crashed worker (e.g. killed for memory) fails its own requests and is restarted,
+    # unless it could not load the models, then it stays out of dispatch. dying before it reported
+    # ready (e.g. a segfault or OOM kill while loading the weights) counts as not loading, so a
+    # worker that can never start is not restarted forever
+    def _replace_dead_workers(self):
+        dead = [i for i, worker in enumerate(self.workers)
+                if not worker['process'].is_alive() and not worker['retired']]
+        if not dead or self.closing:
+            return
+        # a dead worker's last replies (e.g. its 'failed' report) are already in the queue, handle them first
+        while True:
+            try:
+                self._handle_result(*self.results.get_nowait())
+            except queue.Empty:
+                break
+        for i in dead:
+            worker = self.workers[i]
+            with self.lock:
+                lost = [self.futures.pop(task_id) for task_id in worker['inflight'] if task_id in self.futures]
+                worker['inflight'].clear()
+                if not worker['started'] and worker['failed'] is None:
+                    worker['failed'] = f'exited with code {worker["process"].exitcode} while loading'
+            if worker['failed'] is not None and not self.ready.is_set():
+                self.error = worker['failed']
+                self.ready.set()
+            with self.lock:
+                if worker['failed'] is None and self.error is None:
+                    self.workers[i] = self._start_worker(i)
+                else:
+                    worker['retired'] = True
+            # nobody reads the old queue any more, don't block exit flushing tasks into it
+            worker['tasks'].cancel_join_thread()
+            worker['tasks'].close()
+            for future in lost:
+                future.set_exception(RuntimeError(f'model worker exited with code {worker["process"].exitcode}'))
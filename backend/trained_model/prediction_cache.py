@@ -0,0 +1,165 @@
+# content-hash cache for predictions: in-memory LRU in front of an optional SQLite file
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# key for an image's bytes under a given model version
+def content_key(data:bytes, version:str=''):
+    h = hashlib.blake2b(data, digest_size=20)
+    h.update(version.encode())
+    return h.hexdigest()
+
+
+# same key as content_key, hashed from a binary stream in 1 MB chunks instead of one read
+def stream_key(f, version:str=''):
+    h = hashlib.blake2b(digest_size=20)
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    h.update(version.encode())
+    return h.hexdigest()
+
+
+# version string for a set of weight files, changes whenever any of their contents change
+# None paths are skipped, and paths that are not files on disk (e.g. model names ultralytics downloads) are hashed by name
+def file_version(*paths):
+    h = hashlib.blake2b(digest_size=12)
+    for path in paths:
+        if path is None:
+            continue
+        if not os.path.isfile(path):
+            h.update(os.fsencode(path))
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class PredictionCache:
+    TOUCH_BATCH = 256
+
+    def __init__(self, max_entries:int=1024, db_path:str=None, max_db_entries:int=100_000):
+        '''
+        max_entries: size of the in-memory LRU tier
+        db_path: PATH to a SQLite file for the on-disk tier, None keeps the cache in memory only
+        max_db_entries: size bound for the on-disk tier, least recently used rows are evicted first
+        values must be JSON serializable, get() and put() copy them so callers may mutate what they hold
+        '''
+        self.max_entries = max_entries
+        self.max_db_entries = max_db_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # disk hits only bump last_used in memory, written with the next put or every TOUCH_BATCH hits
+        self.touched = {}
+
+        self.db_path = db_path
+        self.conn = None
+        if db_path:
+            self.connect()
+            # a forked worker (gunicorn --preload) reopens the file instead of sharing the parent's handle
+            os.register_at_fork(after_in_child=self.connect)
+
+
+    # open the on-disk tier, with a fresh lock since one held at fork time would never be released
+    def connect(self):
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # same settings as backend/app/db.py: readers don't wait on writers, fsync only at checkpoints
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS predictions (
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL,
+          last_used REAL NOT NULL
+        ) ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions(last_used)')
+        self.conn.commit()
+        self.db_entries = self.conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+
+    # count_miss=False is for fast-path peeks whose misses are looked up (and counted) again later
+    def get(self, key, count_miss:bool=True):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self.memory[key])
+
+            if self.conn is not None:
+                row = self.conn.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.touched[key] = time.time()
+                    if len(self.touched) >= self.TOUCH_BATCH:
+                        self._flush_touched()
+                        self.conn.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return copy.deepcopy(value)
+
+            if count_miss:
+                self.misses += 1
+            return None
+
+
+    def put(self, key, value):
+        with self.lock:
+            self._remember(key, copy.deepcopy(value))
+            if self.conn is None:
+                return
+
+            # eviction goes by last_used, so it has to see the pending touches
+            self._flush_touched()
+            cursor = self.conn.execute('INSERT OR IGNORE INTO predictions (key, value, last_used) VALUES (?, ?, ?)',
+                                       (key, json.dumps(value), time.time()))
+            self.db_entries += cursor.rowcount
+            if self.db_entries > self.max_db_entries:
+                # evict the oldest tenth in one statement rather than one row per insert
+                evict = self.db_entries - self.max_db_entries + self.max_db_entries // 10
+                self.conn.execute('DELETE FROM predictions WHERE key IN '
+                                  '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (evict,))
+                self.db_entries = self.conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            self.conn.commit()
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'disk_entries': self.db_entries if self.conn is not None else 0,
+            }
+
+
+    # write the last_used times of disk hits since the last flush, the caller commits
+    def _flush_touched(self):
+        if self.touched:
+            self.conn.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                  [(used, key) for key, used in self.touched.items()])
+            self.touched.clear()
+
+
+    # insert into the LRU tier, dropping the least recently used entry when full
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,175 @@
+import io
+import math
+import os
+import tempfile
+from types import SimpleNamespace
+import torch
+from PIL import Image
+
+from batcher import MicroBatcher
+from benchmark import SyntheticBoxes, SyntheticMasks
+from cnn_inference import ClassifyFlower, prepare_flower
+from export_model import export_model, load_engine, sample_inputs
+from model_init import get_model
+from prediction_cache import PredictionCache
+
+
+# mask in the segmenter's letterboxed frame: the image scaled to fit frame_w x frame_h and centred,
+# 1 over the image and 0 over the padding
+def letterboxed_mask(width, height, frame_w, frame_h):
+    gain = min(frame_w / width, frame_h / height)
+    pad_x, pad_y = round((frame_w - width * gain) / 2), round((frame_h - height * gain) / 2)
+    mask = torch.zeros(frame_h, frame_w)
+    mask[pad_y:frame_h - pad_y, pad_x:frame_w - pad_x] = 1
+    return mask
+
+
+def test_mask_letterbox():
+    # a wide photo in a square (mixed-shape batch) frame, the padding must not reach the flower
+    img = Image.new('RGB', (800, 400), (200, 100, 50))
+    flower = prepare_flower(img, letterboxed_mask(800, 400, 640, 640))
+    unmasked = prepare_flower(img, torch.ones(320, 640))
+    assert torch.equal(flower, unmasked)
+
+
+# one centred elliptical detection per image, letterboxed the way ultralytics does:
+# a batch of one shape gets a stride-rounded rectangle, mixed shapes a square of imgsz
+def fake_segment(images, imgsz=640):
+    square = len({img.size for img in images}) > 1
+    results = []
+    for img in images:
+        width, height = img.size
+        gain = imgsz / max(width, height)
+        frame_w, frame_h = (imgsz, imgsz) if square else (math.ceil(width * gain / 32) * 32, math.ceil(height * gain / 32) * 32)
+        pad_x, pad_y = (frame_w - width * gain) / 2, (frame_h - height * gain) / 2
+        yy, xx = torch.meshgrid(torch.arange(frame_h) + 0.5, torch.arange(frame_w) + 0.5, indexing='ij')
+        u, v = (xx - pad_x) / (width * gain) * 2 - 1, (yy - pad_y) / (height * gain) * 2 - 1
+        mask = (u ** 2 + v ** 2 <= 0.5).float()
+        results.append(SimpleNamespace(boxes=SyntheticBoxes(width, height), masks=SyntheticMasks(mask[None])))
+    return results
+
+
+def test_batch_matches_single():
+    # random weights: only the preprocessing is compared, the labels themselves mean nothing
+    clfr = ClassifyFlower(get_model, None, 'yolov8n-seg.yaml')
+    clfr.segment = fake_segment
+    inputs = []
+    model = clfr.model
+    clfr.model = lambda batch: (inputs.append(batch), model(batch))[1]
+
+    wide, tall = Image.new('RGB', (800, 400), (200, 100, 50)), Image.new('RGB', (600, 800), (40, 160, 90))
+    single = clfr.predict_batch([wide])
+    mixed = clfr.predict_batch([wide, tall])
+    assert torch.equal(inputs[0][0], inputs[1][0])
+    assert single[0] == mixed[0]
+
+
+def test_cache_returns_copies():
+    # app.run_classification adds 'language' to bouquet results, that must not leak into later hits
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PredictionCache(db_path=os.path.join(tmp, 'cache.db'))
+        flowers = [{'species': 'rose', 'color': 'red'}]
+        cache.put('k', flowers)
+        flowers[0]['language'] = 'love'
+        cache.get('k')[0]['language'] = 'love'
+        assert cache.get('k') == [{'species': 'rose', 'color': 'red'}]
+
+        # disk hits too, from a fresh cache on the same file
+        cache = PredictionCache(db_path=os.path.join(tmp, 'cache.db'))
+        cache.get('k')[0]['language'] = 'love'
+        assert cache.get('k') == [{'species': 'rose', 'color': 'red'}]
+        assert cache.stats()['disk_hits'] == 1
+
+
+def test_batcher_short_results():
+    # a predict_batch that drops inputs must fail every request in the batch, not leave some waiting
+    batcher = MicroBatcher(lambda items: items[:1], max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(3)]
+    for future in futures:
+        assert isinstance(future.exception(timeout=5), RuntimeError)
+    batcher.close()
+
+
+def test_batch_dedupes_repeats():
+    # the same upload twice in one batch is classified once, streams and paths hash like the raw bytes
+    with tempfile.TemporaryDirectory() as tmp:
+        clfr = ClassifyFlower(get_model, None, 'yolov8n-seg.yaml', cache=PredictionCache())
+        clfr.segment = fake_segment
+        inputs = []
+        model = clfr.model
+        clfr.model = lambda batch: (inputs.append(batch), model(batch))[1]
+
+        buf = io.BytesIO()
+        Image.new('RGB', (800, 400), (200, 100, 50)).save(buf, format='PNG')
+        path = os.path.join(tmp, 'flower.png')
+        with open(path, 'wb') as f:
+            f.write(buf.getvalue())
+        assert clfr.cache_key(path) == clfr.cache_key(buf.getvalue()) == clfr.cache_key(io.BytesIO(buf.getvalue()))
+
+        preds = clfr.predict_batch([buf.getvalue(), path, io.BytesIO(buf.getvalue())])
+        assert [batch.size(0) for batch in inputs] == [1]
+        assert preds[0] == preds[1] == preds[2]
+
+
+@torch.no_grad()
+def test_export_roundtrip():
+    # the saved TorchScript file has to load back and give the eager model's logits
+    model = get_model().eval()
+    x = torch.rand(2, 3, 224, 224)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.fp32.ts')
+        export_model(model, 'fp32', path, [x])
+        engine, device = load_engine(get_model, path, 'cpu')
+        for out, ref in zip(engine(x), model(x)):
+            assert torch.allclose(out, ref, atol=1e-3)
+    assert device == 'cpu'
+
+
+def test_calibration_inputs_masked():
+    # int8 calibration sees what serving sees: segmented flowers with the background zeroed
+    segment = ClassifyFlower.segment
+    ClassifyFlower.segment = lambda self, images: fake_segment(images if isinstance(images, list) else [images])
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            Image.new('RGB', (800, 600), (200, 100, 50)).save(os.path.join(tmp, 'flower.jpg'))
+            (x,) = sample_inputs(tmp, 'yolov8n-seg.yaml')
+    finally:
+        ClassifyFlower.segment = segment
+    assert x.shape == (1, 3, 224, 224)
+    zero = (-torch.tensor([0.485, 0.456, 0.406]) / torch.tensor([0.229, 0.224, 0.225])).view(3, 1, 1)
+    assert torch.allclose(x[0, :, 0, 0].view(3, 1, 1), zero)
+    assert not torch.allclose(x[0, :, 112, 112].view(3, 1, 1), zero)
+
+
+def test_read_palette_image():
+    # large PNG/GIF uploads are often palette images, they are reduced like any other
+    clfr = ClassifyFlower(get_model, None, 'yolov8n-seg.yaml')
+    buf = io.BytesIO()
+    Image.new('RGB', (3000, 2000), (200, 100, 50)).quantize(16).save(buf, format='PNG')
+    img, scale = clfr.read_image(buf.getvalue())
+    assert img.mode == 'RGB' and min(img.size) >= clfr.decode_size
+    assert scale == 3.0
+
+
+def test_read_mpo_draft():
+    # phones save multi-frame JPEGs as MPO, those have to be draft-decoded like plain JPEGs
+    clfr = ClassifyFlower(get_model, None, 'yolov8n-seg.yaml')
+    frame = Image.new('RGB', (3000, 2000), (200, 100, 50))
+    buf = io.BytesIO()
+    frame.save(buf, format='MPO', save_all=True, append_images=[frame])
+    assert Image.open(io.BytesIO(buf.getvalue())).format == 'MPO'
+    img, scale = clfr.read_image(buf.getvalue())
+    assert img.mode == 'RGB' and min(img.size) >= clfr.decode_size
+    assert scale == 2.0
+
+
+if __name__ == '__main__':
+    test_mask_letterbox()
+    test_batch_matches_single()
+    test_cache_returns_copies()
+    test_batcher_short_results()
+    test_batch_dedupes_repeats()
+    test_export_roundtrip()
+    test_calibration_inputs_masked()
+    test_read_palette_image()
+    test_read_mpo_draft()
@@ -0,0 +1,73 @@
+# throughput of worker-side per-sample augmentation vs BatchAugment on the training device
+# runs on synthetic data: python bench_augment.py --samples 2048 --workers 4
+import argparse
+import time
+import torch
+from torch.utils.data import Dataset, DataLoader
+import torchvision.transforms as T
+
+from config import Config
+from data.augment import BatchAugment
+
+
+class SyntheticData(Dataset):
+    def __init__(self, samples, transform=None):
+        # uint8 CHW images, like PackedFlowerData with normalize=False
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.randint(0, 256, (samples, 3, 224, 224), dtype=torch.uint8, generator=generator)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        image = self.images[idx]
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, torch.tensor(0), torch.tensor(0)
+
+
+# the same augmentation done per sample with torchvision in the DataLoader workers
+def worker_transform(config):
+    return T.Compose([
+        T.RandomResizedCrop(224, scale=config.aug_scale, ratio=config.aug_ratio, antialias=True),
+        T.RandomHorizontalFlip(config.aug_flip_p),
+        T.ColorJitter(config.aug_brightness, config.aug_contrast, config.aug_saturation),
+        T.ConvertImageDtype(torch.float32),
+        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+
+def images_per_second(loader, device, augment=None):
+    count = 0
+    start = time.perf_counter()
+    for image, _, _ in loader:
+        image = image.to(device, non_blocking=True)
+        if augment is not None:
+            image = augment(image)
+        count += image.size(0)
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+    return count / (time.perf_counter() - start)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=2048)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    cfg = Config()
+    loader_args = dict(batch_size=cfg.batch_size, shuffle=True, num_workers=args.workers,
+                       pin_memory=args.device.startswith('cuda'))
+
+    worker_loader = DataLoader(SyntheticData(args.samples, worker_transform(cfg)), **loader_args)
+    batch_loader = DataLoader(SyntheticData(args.samples), **loader_args)
+
+    worker_rate = images_per_second(worker_loader, args.device)
+    batch_rate = images_per_second(batch_loader, args.device, BatchAugment(cfg, args.device))
+
+    print(f'device {args.device}, {args.workers} workers, batch size {cfg.batch_size}')
+    print(f'  worker-side transforms: {worker_rate:8.1f} images/s')
+    print(f'  batch augment on device: {batch_rate:8.1f} images/s ({batch_rate / worker_rate:.2f}x)')
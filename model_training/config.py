@@ -4,6 +4,10 @@ class Config():
         self.seed = 25
         self.device = 'cuda'
 
+        # multi-process training, launched with torchrun (see models/distributed.py)
+        self.distributed = False
+        self.dist_backend = 'gloo'  # 'nccl' for multi-GPU
+
         # model parameters
         self.num_species = 16
         self.num_colors = 8
@@ -11,6 +15,7 @@ class Config():
         # dataset params
         self.main_csv = 'data/flower_colors_labeled.csv'
         self.val_split = 0.3
+        self.packed_dir = None  # e.g. 'data/packed', written by pack_data.py
 
         # training parameters
         self.epochs = 50
@@ -18,4 +23,23 @@ class Config():
         self.num_workers = 4
         self.lr = 0.001
         self.weight_decay = 1e-5
+        self.checkpoint_every = 1  # epochs between full-state checkpoints (output/<saver>_last.pt)
+
+        # fast path
+        self.amp = True  # fp16 autocast + grad scaler on cuda, bf16 autocast on cpu
+        self.channels_last = True
+        self.grad_accum_steps = 1  # effective batch size = batch_size * grad_accum_steps
+
+        # batch-level augmentation on the training device (data/augment.py)
+        self.augment = False
+        self.aug_scale = (0.6, 1.0)  # random resized crop area
+        self.aug_ratio = (3 / 4, 4 / 3)
+        self.aug_flip_p = 0.5
+        self.aug_brightness = 0.2
+        self.aug_contrast = 0.2
+        self.aug_saturation = 0.1  # kept small and no hue jitter so color labels stay valid
+
+        # train frozen epochs from cached backbone outputs instead of full forward passes
+        self.cache_frozen_features = False
+        self.feature_cache_max_bytes = 4 * 1024**3  # shared by the training and validation caches
 
@@ -0,0 +1,88 @@
+# batch-level augmentation as tensor ops on the training device, after the host->device copy
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment:
+    def __init__(self, config, device):
+        '''
+        random resized crop + horizontal flip (one affine grid_sample), brightness/contrast/saturation
+        jitter and imagenet normalize, all on whole batches
+        there is no hue jitter so the color label stays valid, and the black background left by the
+        segmentation mask is kept black
+        '''
+        self.scale = config.aug_scale
+        self.log_ratio = (math.log(config.aug_ratio[0]), math.log(config.aug_ratio[1]))
+        self.flip_p = config.aug_flip_p
+        self.brightness = config.aug_brightness
+        self.contrast = config.aug_contrast
+        self.saturation = config.aug_saturation
+
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
+        self.gray = torch.tensor([0.299, 0.587, 0.114], device=device).view(1, 3, 1, 1)
+
+
+    # uniform samples in [low, high) for each image in the batch
+    @staticmethod
+    def uniform(n, low, high, device):
+        return torch.empty(n, device=device).uniform_(low, high)
+
+
+    def crop_and_flip(self, images):
+        n, device = images.size(0), images.device
+        area = self.uniform(n, *self.scale, device)
+        ratio = torch.exp(self.uniform(n, *self.log_ratio, device))
+        width = torch.sqrt(area * ratio).clamp(max=1.0)
+        height = torch.sqrt(area / ratio).clamp(max=1.0)
+
+        # crop centre anywhere that keeps the crop inside the image (grid coords are [-1, 1])
+        cx = (torch.rand(n, device=device) * 2 - 1) * (1 - width)
+        cy = (torch.rand(n, device=device) * 2 - 1) * (1 - height)
+        flip = torch.where(torch.rand(n, device=device) < self.flip_p, -1.0, 1.0)
+
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = width * flip
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = height
+        theta[:, 1, 2] = cy
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+
+    def jitter(self, images):
+        n, device = images.size(0), images.device
+        foreground = images.amax(dim=1, keepdim=True) > 0
+
+        brightness = self.uniform(n, 1 - self.brightness, 1 + self.brightness, device).view(n, 1, 1, 1)
+        images = images * brightness
+
+        # contrast blends towards the mean grey of the flower itself, not the black background
+        gray = (images * self.gray).sum(dim=1, keepdim=True)
+        flower_mean = (gray * foreground).sum(dim=(2, 3), keepdim=True) / foreground.sum(dim=(2, 3), keepdim=True).clamp(min=1)
+        contrast = self.uniform(n, 1 - self.contrast, 1 + self.contrast, device).view(n, 1, 1, 1)
+        images = (images - flower_mean) * contrast + flower_mean
+
+        saturation = self.uniform(n, 1 - self.saturation, 1 + self.saturation, device).view(n, 1, 1, 1)
+        gray = (images * self.gray).sum(dim=1, keepdim=True)
+        images = (images - gray) * saturation + gray
+
+        return images.clamp_(0, 1).mul_(foreground)
+
+
+    @torch.no_grad()
+    def __call__(self, images, train=True):
+        '''
+        images: (B, 3, H, W) batch on the device, uint8 or float in [0, 1]
+        train: False only normalizes (validation)
+        '''
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        else:
+            images = images.float()
+
+        if train:
+            images = self.jitter(self.crop_and_flip(images))
+
+        return images.sub_(self.mean).div_(self.std)
@@ -1,9 +1,12 @@
 # load kaggle dataset
 import os
+import json
+import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset
 import torchvision.transforms as T
+from tqdm import tqdm
 
 transform = T.Compose([
     T.ToTensor(),
@@ -11,38 +14,131 @@ transform = T.Compose([
             std=[0.229, 0.224, 0.225])
 ])
 
+# used when normalizing happens on the device (config.augment)
+to_tensor = T.ToTensor()
+
 class FlowerData(Dataset):
-    def __init__(self, config, encode_species, encode_color):
-        # load df
-        df = pd.read_csv(config.main_csv)
-        self.samples = []
+    def __init__(self, config, encode_species, encode_color, normalize=True):
+        # load df, only the columns we need and as strings
+        df = pd.read_csv(config.main_csv, usecols=['Mask Path', 'Species', 'color_label'], dtype=str)
         
         # functions that will encode labels
         self.encode_species = encode_species
         self.encode_color = encode_color
 
-        # append path and labels
-        for index, row in df.iterrows():
-            path = 'data/' + str(row['Mask Path'])
-            species = self.encode_species[str(row['Species'])]
-            color = self.encode_color[str(row['color_label'])]
-            #print(color, species, path)
-            self.samples.append((path, species, color))
-        #print(len(self.samples))
+        # encode whole columns at once, fail fast on anything the encoders don't know
+        species = df['Species'].map(self.encode_species)
+        colors = df['color_label'].map(self.encode_color)
+        for column, encoded in (('Species', species), ('color_label', colors)):
+            unknown = df.loc[encoded.isna(), column]
+            if len(unknown):
+                raise ValueError(f'{config.main_csv}: unknown {column} labels {sorted(unknown.astype(str).unique())} '
+                                 f'(first at row {unknown.index[0]})')
+        missing = df['Mask Path'].isna()
+        if missing.any():
+            raise ValueError(f'{config.main_csv}: {missing.sum()} rows have no Mask Path (first at row {missing.idxmax()})')
+
+        # compact index: every path in one UTF-8 buffer with start offsets (a numpy str table is
+        # fixed-width UCS-4, 4x larger) plus int8 label arrays, cheap to pickle into every DataLoader worker
+        encoded = df['Mask Path'].str.encode('utf-8')
+        self.path_data = b''.join(encoded)
+        self.path_offsets = np.concatenate(([0], np.cumsum(encoded.str.len()))).astype(np.int64)
+        self.species = species.to_numpy(dtype=np.int8)
+        self.colors = colors.to_numpy(dtype=np.int8)
+
+        # False leaves normalizing (and augmenting) to the training loop
+        self.transform = transform if normalize else to_tensor
         
     
     def __len__(self):
-        return len(self.samples)
+        return len(self.species)
     
     def __getitem__(self,idx):
-        path, species, color = self.samples[idx]
-        image = torch.load(path)
+        species, color = int(self.species[idx]), int(self.colors[idx])
+        image = torch.load(self.path(idx))
         #print(image.shape)
-        image = transform(image)
+        image = self.transform(image)
         #print(image.shape)
 
         return image, torch.tensor(species, dtype=torch.long), torch.tensor(color, dtype=torch.long)
 
+    # mask file of sample idx
+    def path(self, idx):
+        start, end = self.path_offsets[idx], self.path_offsets[idx + 1]
+        return 'data/' + self.path_data[start:end].decode('utf-8')
+
+
+# one-time packing of every sample into a single memory-mapped array
+def pack_dataset(dataset, out_dir):
+    '''
+    dataset: FlowerData to pack, sample order is kept so train/val splits stay the same
+    out_dir: folder for images.npy (N, C, H, W), species.npy, colors.npy (int8) and meta.json
+    uint8 masks are stored as uint8, float masks as float16
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    first = np.asarray(torch.load(dataset.path(0)))
+    height, width, channels = first.shape
+    dtype = np.uint8 if first.dtype == np.uint8 else np.float16
+
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+', dtype=dtype,
+                                       shape=(len(dataset), channels, height, width))
+
+    for i in tqdm(range(len(dataset)), desc='Packing'):
+        path = dataset.path(i)
+        image = np.asarray(torch.load(path))
+        if image.shape != first.shape:
+            raise ValueError(f'{path} has shape {image.shape}, expected {first.shape}')
+        images[i] = image.transpose(2, 0, 1)  # HWC -> CHW, what ToTensor would give
+
+    images.flush()
+    np.save(os.path.join(out_dir, 'species.npy'), dataset.species)
+    np.save(os.path.join(out_dir, 'colors.npy'), dataset.colors)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        # ToTensor scales uint8 to [0, 1] and leaves floats alone
+        json.dump({'count': len(dataset), 'scale': 1 / 255 if dtype == np.uint8 else 1.0}, f)
+
+
+class PackedFlowerData(Dataset):
+    def __init__(self, config, normalize=True):
+        '''
+        serves samples written by pack_dataset from config.packed_dir
+        normalize: apply ToTensor scaling + imagenet Normalize here, False returns the stored
+                   tensor as a zero-copy view and leaves normalizing to the training loop
+        '''
+        self.packed_dir = config.packed_dir
+        self.normalize = normalize
+
+        with open(os.path.join(self.packed_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.scale = meta['scale']
+        self.species = torch.from_numpy(np.load(os.path.join(self.packed_dir, 'species.npy')).astype(np.int64))
+        self.colors = torch.from_numpy(np.load(os.path.join(self.packed_dir, 'colors.npy')).astype(np.int64))
+
+        # opened lazily so each DataLoader worker maps the file itself instead of pickling it
+        self.images = None
+
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.species)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            # copy-on-write mapping: pages are shared between workers and torch gets a writable view
+            self.images = np.load(os.path.join(self.packed_dir, 'images.npy'), mmap_mode='c')
+        image = torch.from_numpy(self.images[idx])
+
+        if self.normalize:
+            image = image.to(torch.float32).mul_(self.scale).sub_(self.mean).div_(self.std)
+
+        return image, self.species[idx], self.colors[idx]
+
 
 '''encode_species = {'astilbe': 0, 
                   'bellflower': 1, 
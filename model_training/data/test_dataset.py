@@ -0,0 +1,28 @@
+import os
+import pickle
+from types import SimpleNamespace
+import pandas as pd
+
+from dataset import FlowerData
+
+csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flower_colors_labeled.csv')
+
+
+def test_index_pickles_small():
+    # the index is pickled into every DataLoader worker, it must not be bigger than a plain list of tuples
+    df = pd.read_csv(csv_path, dtype=str)
+    encode_species = {name: i for i, name in enumerate(sorted(df['Species'].unique()))}
+    encode_color = {name: i for i, name in enumerate(sorted(df['color_label'].unique()))}
+    dataset = FlowerData(SimpleNamespace(main_csv=csv_path), encode_species, encode_color)
+
+    samples = [('data/' + path, encode_species[species], encode_color[color])
+               for path, species, color in zip(df['Mask Path'], df['Species'], df['color_label'])]
+    assert len(pickle.dumps(dataset)) <= len(pickle.dumps(samples))
+
+    # paths come back as the same strings
+    assert dataset.path(0) == samples[0][0]
+    assert dataset.path(len(dataset) - 1) == samples[-1][0]
+
+
+if __name__ == '__main__':
+    test_index_pickles_small()
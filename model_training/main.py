@@ -1,14 +1,17 @@
+import argparse
 import torch
 from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
 from sklearn.model_selection import train_test_split
 import csv
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 from config import Config
-from data.dataset import FlowerData
+from data.dataset import FlowerData, PackedFlowerData
 from models.model_init import get_model
 from models.train import train
+from models.distributed import setup_distributed, cleanup_distributed, ShardSampler
 
 # dictionaries to encode flower and color labels
 encode_species = {'astilbe': 0, 'bellflower': 1, 'black_eyed_susan': 2, 'calendula': 3, 'california_poppy': 4, 
@@ -19,9 +22,17 @@ encode_color = {'white': 0, 'yellow': 1, 'orange': 2, 'pink': 3, 'red': 4, 'purp
 
 
 # orchestrates model training
-def main(config, saver):
-    # load full dataset
-    full_dataset = FlowerData(config, encode_species, encode_color)
+def main(config, saver, resume=False):
+    # one process per device when distributed, sets config.device for this rank
+    rank, world_size = setup_distributed(config)
+
+    # load full dataset, from the memory-mapped pack if there is one
+    # with config.augment the samples stay unnormalized and train() augments/normalizes on the device
+    normalize = not config.augment
+    if config.packed_dir:
+        full_dataset = PackedFlowerData(config, normalize)
+    else:
+        full_dataset = FlowerData(config, encode_species, encode_color, normalize)
 
     # get indices for train/val split
     indices = list(range(len(full_dataset)))
@@ -30,20 +41,34 @@ def main(config, saver):
     train_subset = Subset(full_dataset, train_idx)
     val_subset = Subset(full_dataset, val_idx)
 
-    train_loader = DataLoader(train_subset, batch_size = config.batch_size, shuffle=True, num_workers=config.num_workers, pin_memory=True, persistent_workers=True)
-    val_loader = DataLoader(val_subset, batch_size = config.batch_size, shuffle=False, num_workers=config.num_workers, pin_memory=True, persistent_workers=True)
+    # each rank gets its own shard of the same split
+    train_sampler, val_sampler = None, None
+    if config.distributed:
+        train_sampler = DistributedSampler(train_subset, num_replicas=world_size, rank=rank, shuffle=True, seed=config.seed)
+        # unpadded, so the reduced confusion matrices count every validation sample once
+        val_sampler = ShardSampler(val_subset, num_replicas=world_size, rank=rank)
+
+    train_loader = DataLoader(train_subset, batch_size = config.batch_size, shuffle=train_sampler is None, sampler=train_sampler, num_workers=config.num_workers, pin_memory=True, persistent_workers=True)
+    val_loader = DataLoader(val_subset, batch_size = config.batch_size, shuffle=False, sampler=val_sampler, num_workers=config.num_workers, pin_memory=True, persistent_workers=True)
 
     # get CNN model
     model = get_model(config)
     model.to(config.device)
 
     # train model
-    train(config, model, saver, train_loader, val_loader)
+    train(config, model, saver, train_loader, val_loader, resume)
+    cleanup_distributed()
 
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--saver', default='test1.2', help='name used for the output csv and checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from output/<saver>_last.pt')
+    args = parser.parse_args()
+
     print(f'CUDA? {torch.cuda.is_available()}')
-    print(f'Device? {torch.cuda.current_device()}')
+    if torch.cuda.is_available():
+        print(f'Device? {torch.cuda.current_device()}')
 
     cfg = Config()
-    main(cfg, 'test1.2')    
+    main(cfg, args.saver, args.resume)    
@@ -0,0 +1,74 @@
+# full training-state checkpoints, written from a background thread
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+# copy every tensor in a (nested) state dict to the cpu so training can keep mutating the originals
+def snapshot(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def capture_rng():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def restore_rng(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncCheckpointer:
+    def __init__(self):
+        '''
+        save() only copies tensors to the cpu on the calling thread, torch.save runs in the background
+        files are written to a temporary name and renamed, so a crash never leaves a half-written checkpoint
+        '''
+        self.queue = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self._run, name='checkpointer', daemon=True)
+        self.worker.start()
+
+    def save(self, state, path):
+        if self.error is not None:
+            raise RuntimeError('previous checkpoint failed to save') from self.error
+        self.queue.put((snapshot(state), path))
+
+    # wait for the queued checkpoints, raises if any of them failed to save
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise RuntimeError('checkpoint failed to save') from self.error
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.queue.task_done()
+                return
+            state, path = entry
+            try:
+                tmp_path = f'{path}.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
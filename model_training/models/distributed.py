@@ -0,0 +1,80 @@
+# helpers for multi-process DistributedDataParallel training
+# set config.distributed = True and launch one process per device, e.g. on each machine:
+#   torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=host:29500 main.py
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+
+
+def setup_distributed(config):
+    '''
+    join the process group described by torchrun's environment variables and pick this rank's device
+    gloo works on CPU-only clusters, nccl needs one GPU per process
+    returns (rank, world_size), (0, 1) when not distributed
+    '''
+    if not config.distributed:
+        return 0, 1
+
+    dist.init_process_group(config.dist_backend)
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if str(config.device).startswith('cuda') and torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        config.device = f'cuda:{local_rank}'
+    else:
+        config.device = 'cpu'
+    return dist.get_rank(), dist.get_world_size()
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+# every rank's share of a dataset for evaluation: no padding, so each sample is counted exactly once
+# and shards differ by at most one sample (DistributedSampler repeats samples to even them out)
+class ShardSampler(Sampler):
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = range(rank, len(dataset), num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+# sum tensors across ranks in place, no-op when not distributed
+def all_reduce_sum(*tensors):
+    if dist.is_initialized():
+        for tensor in tensors:
+            dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensors if len(tensors) > 1 else tensors[0]
+
+
+# wrap for the forward pass, must be redone when the set of trainable parameters changes
+def wrap_model(model, config):
+    if not config.distributed:
+        return model
+    device_ids = [torch.device(config.device).index] if str(config.device).startswith('cuda') else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+# average gradients by hand for passes that bypass the DDP wrapper (cached features)
+def average_gradients(model):
+    if not dist.is_initialized():
+        return
+    size = dist.get_world_size()
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+            param.grad.div_(size)
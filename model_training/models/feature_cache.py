@@ -0,0 +1,130 @@
+# caches the output of the frozen part of the backbone so frozen epochs only train what is unfrozen
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from models.distributed import is_main_process
+
+
+# split model.backbone into (frozen, trainable) for unfreeze step 0-4
+def split_backbone(model, step):
+    backbone = model.backbone
+    stages = [
+        nn.Sequential(backbone.conv1, backbone.bn1, backbone.relu, backbone.maxpool),
+        backbone.layer1, backbone.layer2, backbone.layer3, backbone.layer4,
+        nn.Sequential(backbone.avgpool, nn.Flatten(1), backbone.fc),
+    ]
+    # step 0: everything frozen, the cache holds the 2048-d features
+    # step n: layer4 .. layer(5 - n) are trainable, the cache holds the input to the lowest of them
+    cut = len(stages) if step <= 0 else len(stages) - 1 - step
+    return nn.Sequential(*stages[:cut]), nn.Sequential(*stages[cut:])
+
+
+# put the frozen part of the backbone in eval mode after model.train(). while features are cached
+# the frozen batchnorm layers must not update their running stats, even on epochs that run the
+# full model (augmented training, cache over budget), or the cached features go stale
+def freeze_batchnorm(model, step):
+    split_backbone(model, min(step, 4))[0].eval()
+
+
+class CacheBudget:
+    def __init__(self, max_bytes):
+        '''
+        max_bytes: device memory shared by every FeatureCache built with this budget
+        '''
+        self.max_bytes = max_bytes
+        self.caches = []
+
+    def available(self):
+        return self.max_bytes - sum(cache.nbytes() for cache in self.caches)
+
+
+class FeatureCache:
+    def __init__(self, budget):
+        '''
+        budget: CacheBudget this cache's tensors count against, deeper unfreeze steps that
+                would need more than is left fall back to the normal full forward pass
+        '''
+        self.budget = budget
+        budget.caches.append(self)
+        self.step = None
+        self.trainable = None
+        self.features = None
+        self.species = None
+        self.colors = None
+
+
+    # drop cached features, they are only valid for the step they were built at
+    def clear(self):
+        self.step = None
+        self.features, self.species, self.colors = None, None, None
+
+
+    def nbytes(self):
+        if self.features is None:
+            return 0
+        return sum(t.numel() * t.element_size() for t in (self.features, self.species, self.colors))
+
+
+    @torch.no_grad()
+    def prepare(self, model, step, loader, device, transform=None):
+        '''
+        make sure features for this unfreeze step are cached, rebuilding when the step changed
+        transform: optional function applied to each image batch on the device (normalizing)
+        frozen layers run in eval mode here, so their batchnorm uses running stats
+        returns True if the cache can be used this epoch
+        '''
+        step = min(step, 4)  # nothing else thaws after layer1
+        if step == self.step:
+            return self.features is not None
+
+        # caches of the previous step are stale, free them before measuring what is left
+        for cache in self.budget.caches:
+            if cache.step != step:
+                cache.clear()
+        self.step = step
+        frozen, self.trainable = split_backbone(model, step)
+
+        was_training = frozen.training
+        frozen.eval()
+        offset = 0
+        for image, species_label, color_label in tqdm(loader, desc=f'Caching features (step {step})', disable=not is_main_process()):
+            image = image.to(device)
+            if transform is not None:
+                image = transform(image)
+            feats = frozen(image)
+
+            if self.features is None:
+                n = len(loader.sampler)  # this rank's shard when training is distributed
+                needed = (feats[0].numel() * feats.element_size() + 2 * 8) * n
+                if needed > self.budget.available():
+                    if is_main_process():
+                        print(f'Feature cache for step {step} needs {needed / 1e9:.1f} GB, running full forward passes')
+                    break
+                self.features = torch.empty((n, *feats.shape[1:]), dtype=feats.dtype, device=device)
+                self.species = torch.empty(n, dtype=torch.long, device=device)
+                self.colors = torch.empty(n, dtype=torch.long, device=device)
+
+            batch = feats.size(0)
+            self.features[offset:offset + batch] = feats
+            self.species[offset:offset + batch] = species_label.to(device)
+            self.colors[offset:offset + batch] = color_label.to(device)
+            offset += batch
+        frozen.train(was_training)
+
+        return self.features is not None
+
+
+    # (features, species, color) batches from the cache, shuffled on the device
+    def batches(self, batch_size, shuffle=True):
+        n = self.features.size(0)
+        order = torch.randperm(n, device=self.features.device) if shuffle else torch.arange(n, device=self.features.device)
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+            yield self.features[idx], self.species[idx], self.colors[idx]
+
+
+    # the rest of the model on top of cached features
+    def forward(self, model, feats):
+        feats = self.trainable(feats)
+        return model.species_classifier(feats), model.color_classifier(feats)
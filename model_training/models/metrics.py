@@ -0,0 +1,44 @@
+# streaming classification metrics kept on the training device
+import torch
+
+
+class ConfusionMatrix:
+    def __init__(self, num_classes, device):
+        '''
+        num_classes: number of labels, rows of the matrix are true labels and columns predictions
+        memory stays fixed at num_classes^2 however many batches are added
+        '''
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.matrix.zero_()
+
+    # add a batch of predictions with one vectorized bincount
+    def update(self, preds, labels):
+        idx = labels.view(-1) * self.num_classes + preds.view(-1)
+        self.matrix += torch.bincount(idx, minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    # one device sync, everything else is computed from the small cpu copy
+    def compute(self):
+        '''
+        returns dict with accuracy, macro_f1 and per_class_recall
+        macro F1 averages over classes seen in labels or predictions, matching sklearn's f1_score(average='macro')
+        '''
+        matrix = self.matrix.cpu().double()
+        tp = matrix.diag()
+        support = matrix.sum(dim=1)
+        predicted = matrix.sum(dim=0)
+
+        precision = torch.where(predicted > 0, tp / predicted.clamp(min=1), torch.zeros_like(tp))
+        recall = torch.where(support > 0, tp / support.clamp(min=1), torch.zeros_like(tp))
+        denom = precision + recall
+        f1 = torch.where(denom > 0, 2 * precision * recall / denom.clamp(min=1e-12), torch.zeros_like(tp))
+
+        present = (support + predicted) > 0
+        total = support.sum()
+        return {
+            'accuracy': (tp.sum() / total).item() if total > 0 else 0.0,
+            'macro_f1': f1[present].mean().item() if present.any() else 0.0,
+            'per_class_recall': recall.tolist(),
+        }
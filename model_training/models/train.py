@@ -2,9 +2,15 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import csv
+from contextlib import nullcontext
 from tqdm import tqdm
 import os
-from sklearn.metrics import f1_score
+
+from models.feature_cache import CacheBudget, FeatureCache, freeze_batchnorm
+from models.metrics import ConfusionMatrix
+from data.augment import BatchAugment
+from models.checkpoint import AsyncCheckpointer, capture_rng, restore_rng
+from models.distributed import wrap_model, is_main_process, world_size, all_reduce_sum, average_gradients
 
 # function to unfreeze our model layer by layer
 def unfreeze_model_layer(model, step, optimizer, lr):
@@ -16,7 +22,8 @@ def unfreeze_model_layer(model, step, optimizer, lr):
         return  # nothing to unfreeze
     
     layer_to_unfreeze = resnet_layers[step - 1]
-    print(f"Unfreezing {layer_to_unfreeze}")
+    if is_main_process():
+        print(f"Unfreezing {layer_to_unfreeze}")
 
     layer = getattr(model.backbone, layer_to_unfreeze)
     for param in layer.parameters():
@@ -29,153 +36,290 @@ def unfreeze_model_layer(model, step, optimizer, lr):
         optimizer.add_param_group({'params': new_params, 'lr': lr})
 
 
+# move a batch to the device, images (not cached 2048-d features) in the requested memory format
+def to_device(image, device, memory_format):
+    if image.dim() == 4:
+        return image.to(device, non_blocking=True, memory_format=memory_format)
+    return image.to(device, non_blocking=True)
+
+
+# keep the header and the rows of epochs up to last_epoch
+def truncate_log(path, last_epoch):
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    keep = rows[:1] + [row for row in rows[1:] if row and int(row[0]) <= last_epoch]
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(keep)
+
+
 # training loop
-def train(config, model, saver, train_loader, val_loader):
-    # set up csv for logging
-    os.makedirs("output", exist_ok=True)
-    csv_file = open(f'output/{saver}.csv', mode='w', newline='')
-    csv_writer = csv.writer(csv_file)
-    csv_writer.writerow(['Epoch', 'Train Loss', 'Train Species Accuracy', 'Train Color Accuracy',
-                         'Val Loss', 'Val Species Accuracy', 'Val Color Accuracy',
-                         'Species F1', 'Colors F1', 'Avg F1'])
+def train(config, model, saver, train_loader, val_loader, resume=False):
+    # only rank 0 logs and saves when training is distributed
+    main_process = is_main_process()
+
+    # full training state from output/{saver}_last.pt, if asked to and it exists
+    ckpt_path = f'output/{saver}_last.pt'
+    checkpoint = None
+    if resume:
+        if os.path.exists(ckpt_path):
+            checkpoint = torch.load(ckpt_path, map_location='cpu', weights_only=False)
+        elif main_process:
+            print(f'No checkpoint at {ckpt_path}, starting from scratch')
+
+    # set up csv for logging, appending to the old log when resuming
+    if main_process:
+        os.makedirs("output", exist_ok=True)
+        log_path = f'output/{saver}.csv'
+        append = checkpoint is not None and os.path.exists(log_path)
+        if append:
+            # epochs after the checkpoint (checkpoint_every > 1) run again, drop their rows so they aren't logged twice
+            truncate_log(log_path, checkpoint['epoch'])
+        csv_file = open(log_path, mode='a' if append else 'w', newline='')
+        csv_writer = csv.writer(csv_file)
+        if not append:
+            csv_writer.writerow(['Epoch', 'Train Loss', 'Train Species Accuracy', 'Train Color Accuracy',
+                                 'Val Loss', 'Val Species Accuracy', 'Val Color Accuracy',
+                                 'Species F1', 'Colors F1', 'Avg F1']
+                                + [f'Species {i} Recall' for i in range(config.num_species)]
+                                + [f'Color {i} Recall' for i in range(config.num_colors)])
 
     # set up training params
     device = config.device
+    species_cm = ConfusionMatrix(config.num_species, device)
+    color_cm = ConfusionMatrix(config.num_colors, device)
     criterion = nn.CrossEntropyLoss().to(device)
     optimizer = optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()),
                                    lr = config.lr, 
                                    weight_decay = config.weight_decay)
 
+    # mixed precision: fp16 + grad scaling on cuda, bf16 (no scaling needed) on cpu
+    device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+    amp_dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    scaler = torch.amp.GradScaler(device_type, enabled=config.amp and device_type == 'cuda')
+    memory_format = torch.channels_last if config.channels_last else torch.contiguous_format
+    model.to(memory_format=memory_format)
+    accum_steps = config.grad_accum_steps
+
     # unfreezing model params
     unfreeze_step = 0
 
     best_f1 = 0.0
     patience_counter = 0
-
-    for epoch in range(config.epochs):
+    start_epoch = 0
+
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        # replay the unfreezing so the optimizer has the same param groups as when it was saved
+        for step in range(1, checkpoint['unfreeze_step'] + 1):
+            unfreeze_model_layer(model, step, optimizer, config.lr)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        unfreeze_step = checkpoint['unfreeze_step']
+        best_f1 = checkpoint['best_f1']
+        patience_counter = checkpoint['patience_counter']
+        start_epoch = checkpoint['epoch'] + 1
+        restore_rng(checkpoint['rng'])
+        if main_process:
+            print(f'Resuming from epoch {start_epoch} (best F1 {best_f1:.3f})')
+        checkpoint = None
+
+    # torch.save runs in the background, only the copy to cpu blocks training
+    checkpointer = AsyncCheckpointer() if main_process else None
+
+    # forward passes go through DDP when distributed, everything else uses the plain model
+    ddp_model = wrap_model(model, config)
+
+    # augmentation + normalize on the device, the loaders then hand over unnormalized batches
+    augment = BatchAugment(config, device) if config.augment else None
+    normalize = (lambda x: augment(x, train=False)) if augment is not None else None
+
+    # frozen-layer outputs cached per unfreeze step, rebuilt whenever another layer thaws
+    # (training features change every epoch when augmenting, so only validation is cached then)
+    # both caches share one feature_cache_max_bytes budget on the device
+    train_cache, val_cache = None, None
+    if config.cache_frozen_features:
+        budget = CacheBudget(config.feature_cache_max_bytes)
+        if augment is None:
+            train_cache = FeatureCache(budget)
+        val_cache = FeatureCache(budget)
+
+    for epoch in range(start_epoch, config.epochs):
         if epoch % 3 == 0 and epoch != 0:
             current_lr = optimizer.param_groups[0]['lr']
             unfreeze_step += 1
             unfreeze_model_layer(model, unfreeze_step, optimizer, current_lr)
+            if config.distributed:
+                ddp_model = wrap_model(model, config)  # pick up the newly trainable layer
+
+        # reshuffle each rank's shard every epoch
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
 
         ### initiate model training ###
         model.train()
-        running_loss = 0.0
-        correct_species, correct_color, total = 0, 0, 0
-
-        for batch_idx, (image, species_label, color_label) in enumerate(tqdm(train_loader, desc=f'Training Epoch {epoch}')):
+        if config.cache_frozen_features:
+            freeze_batchnorm(model, unfreeze_step)
+        # metrics stay on the device and are synced once per epoch
+        running_loss = torch.zeros((), device=device)
+        correct_species = torch.zeros((), dtype=torch.long, device=device)
+        correct_color = torch.zeros((), dtype=torch.long, device=device)
+        total = 0
+
+        batches, forward = train_loader, ddp_model
+        if train_cache is not None and train_cache.prepare(model, unfreeze_step, train_loader, device):
+            batches = train_cache.batches(config.batch_size, shuffle=True)
+            forward = lambda x: train_cache.forward(model, x)
+
+        optimizer.zero_grad(set_to_none=True)
+        for batch_idx, (image, species_label, color_label) in enumerate(tqdm(batches, desc=f'Training Epoch {epoch}', total=len(train_loader), disable=not main_process)):
             # prepare features for model
-            image = image.to(device)
-            species_label = species_label.to(device)
-            color_label = color_label.to(device)
+            image = to_device(image, device, memory_format)
+            if augment is not None and forward is ddp_model:
+                image = augment(image, train=True).contiguous(memory_format=memory_format)
+            species_label = species_label.to(device, non_blocking=True)
+            color_label = color_label.to(device, non_blocking=True)
 
-            optimizer.zero_grad()
+            # DDP only needs to all-reduce gradients on batches that step the optimizer
+            step_now = (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == len(train_loader)
+            sync = ddp_model.no_sync if config.distributed and forward is ddp_model and not step_now else nullcontext
 
-            # make predictions and calculate loss
-            species_logits, color_logits = model(image)
-            species_loss = criterion(species_logits, species_label)  # loss for species dim
-            color_loss = criterion(color_logits, color_label)  # loss for color dim
-            loss = species_loss + color_loss  # combine loss
-
-            # update yo self
-            loss.backward()
-            optimizer.step()
+            with sync():
+                # make predictions and calculate loss
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=config.amp):
+                    species_logits, color_logits = forward(image)
+                    species_loss = criterion(species_logits, species_label)  # loss for species dim
+                    color_loss = criterion(color_logits, color_label)  # loss for color dim
+                    loss = species_loss + color_loss  # combine loss
+
+                scaler.scale(loss / accum_steps).backward()
+
+            # update yo self, every accum_steps batches (and at the end of the epoch)
+            if step_now:
+                if config.distributed and forward is not ddp_model:
+                    scaler.unscale_(optimizer)
+                    average_gradients(model)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
             # calculate running 
-            running_loss += loss.item()
+            running_loss += loss.detach()
 
             # calculate accuracies
             _, species_pred = torch.max(species_logits, dim=1)
             _, color_pred = torch.max(color_logits, dim=1)
 
-            correct_species += (species_pred == species_label).sum().item()
-            correct_color += (color_pred == color_label).sum().item()
+            correct_species += (species_pred == species_label).sum()
+            correct_color += (color_pred == color_label).sum()
             total += species_label.size(0)
         
-        # calculate aggregated stats
-        train_loss_avg = running_loss / len(train_loader)
-        species_acc = correct_species / total
-        color_acc = correct_color / total
+        # calculate aggregated stats, summed over every rank
+        total = all_reduce_sum(torch.tensor(total, device=device)).item()
+        all_reduce_sum(running_loss, correct_species, correct_color)
+        train_loss_avg = running_loss.item() / (len(train_loader) * world_size())
+        species_acc = correct_species.item() / total
+        color_acc = correct_color.item() / total
 
         ### initiate validation ###
         model.eval()
-        val_loss = 0.0
-        correct_species, correct_color, total = 0, 0, 0
+        val_loss = torch.zeros((), device=device)
+        val_batches = torch.zeros((), dtype=torch.long, device=device)
 
-        # store predictions and labels for F1
-        all_species_preds, all_species_labels = [], []
-        all_color_preds, all_color_labels = [], []
+        # confusion matrices give accuracy and F1 without keeping every prediction
+        species_cm.reset()
+        color_cm.reset()
+
+        # validation shards are unpadded and may differ by a batch between ranks, so it runs on the
+        # plain model: DDP's forward could wait on a collective the other ranks never reach
+        batches, forward = val_loader, model
+        if val_cache is not None and val_cache.prepare(model, unfreeze_step, val_loader, device, normalize):
+            batches = val_cache.batches(config.batch_size, shuffle=False)
+            forward = lambda x: val_cache.forward(model, x)
 
         with torch.no_grad():
-            for batch_idx, (image, species_label, color_label) in enumerate(tqdm(val_loader, desc=f'Validation Epoch {epoch}')):
+            for batch_idx, (image, species_label, color_label) in enumerate(tqdm(batches, desc=f'Validation Epoch {epoch}', total=len(val_loader), disable=not main_process)):
                 # prep
-                image = image.to(device)
-                species_label = species_label.to(device)
-                color_label = color_label.to(device)
+                image = to_device(image, device, memory_format)
+                if augment is not None and forward is model:
+                    image = normalize(image).contiguous(memory_format=memory_format)
+                species_label = species_label.to(device, non_blocking=True)
+                color_label = color_label.to(device, non_blocking=True)
                 
                 # make predictions and calculate loss
-                species_logits, color_logits = model(image)
-                species_loss = criterion(species_logits, species_label)  # loss for species dim
-                color_loss = criterion(color_logits, color_label)  # loss for color dim
-                loss = species_loss + color_loss  # combine loss
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=config.amp):
+                    species_logits, color_logits = forward(image)
+                    species_loss = criterion(species_logits, species_label)  # loss for species dim
+                    color_loss = criterion(color_logits, color_label)  # loss for color dim
+                    loss = species_loss + color_loss  # combine loss
 
                 # calculate loss 
-                val_loss += loss.item()
+                val_loss += loss
+                val_batches += 1
 
-                # calculate accuracies
+                # accumulate accuracy/F1 business
                 _, species_pred = torch.max(species_logits, dim=1)
                 _, color_pred = torch.max(color_logits, dim=1)
 
-                correct_species += (species_pred == species_label).sum().item()
-                correct_color += (color_pred == color_label).sum().item()
-                total += species_label.size(0)
-
-                # collect F1 business
-                all_species_preds.append(species_pred.cpu())
-                all_species_labels.append(species_label.cpu())
-                all_color_preds.append(color_pred.cpu())
-                all_color_labels.append(color_label.cpu())
+                species_cm.update(species_pred, species_label)
+                color_cm.update(color_pred, color_label)
             
         # calculate aggregated stats
-        val_loss_avg = val_loss / len(val_loader)
-        val_species_acc = correct_species / total
-        val_color_acc = correct_color / total
-
-        # aggregate F1 business
-        all_species_preds = torch.cat(all_species_preds)
-        all_species_labels = torch.cat(all_species_labels)
-        all_color_preds = torch.cat(all_color_preds)
-        all_color_labels = torch.cat(all_color_labels)
+        all_reduce_sum(val_loss, val_batches, species_cm.matrix, color_cm.matrix)
+        val_loss_avg = val_loss.item() / val_batches.item()
+        species_stats = species_cm.compute()
+        color_stats = color_cm.compute()
+        val_species_acc = species_stats['accuracy']
+        val_color_acc = color_stats['accuracy']
 
         # compute F1 business
-        species_f1 = f1_score(all_species_labels.numpy(), all_species_preds.numpy(), average='macro')
-        color_f1 = f1_score(all_color_labels.numpy(), all_color_preds.numpy(), average='macro')
+        species_f1 = species_stats['macro_f1']
+        color_f1 = color_stats['macro_f1']
         avg_f1 = (species_f1 + color_f1) / 2
 
-        print(f"Epoch [{epoch}/{config.epochs}] "
-              f"Train Loss: {train_loss_avg:.4f} | Val Loss: {val_loss_avg:.4f} | "
-              f"Species Acc: {val_species_acc:.3f} | Color Acc: {val_color_acc:.3f} | "
-              f"Species F1: {species_f1:.3f} | Color F1: {color_f1:.3f} | Avg F1: {avg_f1:.3f}")
-        
-        csv_writer.writerow([epoch, train_loss_avg, species_acc, color_acc, 
-                             val_loss_avg, val_species_acc, val_color_acc, 
-                             species_f1, color_f1, avg_f1])
-        csv_file.flush()
+        if main_process:
+            print(f"Epoch [{epoch}/{config.epochs}] "
+                  f"Train Loss: {train_loss_avg:.4f} | Val Loss: {val_loss_avg:.4f} | "
+                  f"Species Acc: {val_species_acc:.3f} | Color Acc: {val_color_acc:.3f} | "
+                  f"Species F1: {species_f1:.3f} | Color F1: {color_f1:.3f} | Avg F1: {avg_f1:.3f}")
+            
+            csv_writer.writerow([epoch, train_loss_avg, species_acc, color_acc, 
+                                 val_loss_avg, val_species_acc, val_color_acc, 
+                                 species_f1, color_f1, avg_f1]
+                                + species_stats['per_class_recall'] + color_stats['per_class_recall'])
+            csv_file.flush()
         
         ### early stopping ###
+        # metrics are all-reduced, so every rank takes the same decision
         if avg_f1 > best_f1:
             best_f1 = avg_f1
             patience_counter = 0
-            torch.save(model.state_dict(), f'output/{saver}_best_model.pt')
-            print(f'\033[34m New Best F1: {avg_f1}; model saved \033[0;0m')
+            if main_process:
+                checkpointer.save(model.state_dict(), f'output/{saver}_best_model.pt')
+                print(f'\033[34m New Best F1: {avg_f1}; model saved \033[0;0m')
         else:
             patience_counter += 1
+
+        # everything needed to pick up after this epoch
+        if main_process and (epoch + 1) % config.checkpoint_every == 0:
+            checkpointer.save({
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict(),
+                'epoch': epoch,
+                'unfreeze_step': unfreeze_step,
+                'best_f1': best_f1,
+                'patience_counter': patience_counter,
+                'rng': capture_rng(),
+            }, ckpt_path)
     
         if patience_counter >= 10:
-            print(f'Early stopping epoch {epoch}')
+            if main_process:
+                print(f'Early stopping epoch {epoch}')
             break
 
-    csv_file.close()
+    if main_process:
+        checkpointer.close()
+        csv_file.close()
         
         
 
@@ -0,0 +1,15 @@
+# pack the per-sample mask files into one memory-mapped array for PackedFlowerData
+# python pack_data.py data/packed, then set config.packed_dir = 'data/packed'
+import sys
+
+from config import Config
+from data.dataset import FlowerData, pack_dataset
+from main import encode_species, encode_color
+
+
+if __name__=='__main__':
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else 'data/packed'
+
+    cfg = Config()
+    pack_dataset(FlowerData(cfg, encode_species, encode_color), out_dir)
+    print(f'packed to {out_dir}')
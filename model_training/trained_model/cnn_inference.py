@@ -1,4 +1,5 @@
 # class to call for inference on an uploaded image
+import threading
 import numpy as np
 import torch
 from PIL import Image
@@ -10,15 +11,36 @@ warnings.simplefilter(action='ignore', category=UserWarning)
 from model_init import get_model
 
 
+# segmentation models are shared by every ClassifyFlower in the process,
+# keyed by weights path, so YOLO is only deserialized once
+_seg_models = {}
+_seg_models_lock = threading.Lock()
+
+
+def get_seg_model(seg_path):
+    '''
+    returns (model, lock) for the YOLO weights at seg_path, building it on first use.
+    ultralytics predictors keep per-call state, so callers hold the lock while predicting
+    '''
+    with _seg_models_lock:
+        if seg_path not in _seg_models:
+            seg_model = YOLO(seg_path)
+            seg_model.eval()
+            _seg_models[seg_path] = (seg_model, threading.Lock())
+        return _seg_models[seg_path]
+
+
 class ClassifyFlower:
     def __init__(self, 
                  model_arch, 
                  weights_path:str='test1.2_best_model.pt', 
-                 seg_path:str='flowers_segmentation_model.pt'):
+                 seg_path:str='flowers_segmentation_model.pt',
+                 warmup:bool=False):
         '''
         model_arch: function for returning model instance/architecture
         model_weights: PATH to the model's weights
         seg_path: PATH to the pretrained YOLO model for image segmentation/masking
+        warmup: run one dummy image through both models so the first real request is not slow
         '''
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -28,6 +50,7 @@ class ClassifyFlower:
         self.model.eval()
 
         self.seg_path = seg_path # path to segmentation model
+        self.seg_model, self.seg_lock = get_seg_model(seg_path)
         
         # image transformations for segmentation model
         self.segmentation_transform = transforms.Compose([
@@ -53,21 +76,30 @@ class ClassifyFlower:
             0: 'white', 1: 'yellow', 2: 'orange', 3: 'pink', 4: 'red', 5: 'purple', 6: 'maroon', 7: 'brown'
         }
 
+        if warmup:
+            self.warmup()
+
+
+    # push a blank image through both models to trigger lazy init (fusing, allocator, kernels)
+    @torch.no_grad()
+    def warmup(self):
+        blank = Image.new('RGB', (640, 640))
+        with self.seg_lock:
+            self.seg_model.predict(blank, conf=0.15, save=False, show=False, verbose=False)
+        self.model(self.inference_transform(blank).unsqueeze(0).to(self.device))
+
 
     # preprocess image
     def load_image(self, image_path):
         error = False
 
-        # load pretrained segmentation model
-        seg_model = YOLO(self.seg_path)
-        seg_model.eval()
-        
         # load image, prep for processing (Image supports .png, .jpg, etc.)
         img_rgb = Image.open(image_path).convert('RGB')
         img_tensor = self.segmentation_transform(img_rgb).unsqueeze(0)
 
         # preprocess - threshold is 15% confidence
-        results = seg_model.predict(img_rgb, conf=0.15, save=False, show=False, verbose=False)
+        with self.seg_lock:
+            results = self.seg_model.predict(img_rgb, conf=0.15, save=False, show=False, verbose=False)
         r = results[0]
         if len(r.boxes) == 0:
             print("No flowers here, fam")